@@ -0,0 +1,29 @@
+"""Backfilled legacy api key hashes
+
+Revision ID: c3d9f5a20b71
+Revises: b7c2e4f19a63
+Create Date: 2026-10-19 21:31:54.662013
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d9f5a20b71'
+down_revision = 'b7c2e4f19a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keys issued before hashing were the row's id. Hash it the way
+    # hash_api_key does, so those keys keep working until they are regenerated.
+    op.execute("""
+        update api_key set hashed_key = encode(sha256(convert_to(id::text, 'UTF8')), 'hex')
+        where hashed_key is null
+    """)
+
+
+def downgrade():
+    pass
@@ -1,6 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
 
 from app.api.api_v1.endpoints import login, search, sources, users
+from app.api.deps import current_superuser
+from app.core.timing import TIMING_ENABLED, render_metrics
 
 api_router = APIRouter()
 api_router.include_router(login.api_router)
@@ -10,4 +13,15 @@ api_router.include_router(users.api_router)
 
 @api_router.get("/health-check")
 def health_check():
-    return {"message": "OK"}
\ No newline at end of file
+    return {"message": "OK"}
+
+
+@api_router.get("/metrics", include_in_schema=False, dependencies=[Depends(current_superuser)])
+def metrics():
+    """Stage latency histograms in Prometheus text format, when SERVER_TIMING is on.
+
+    Superusers only. A scraper can authenticate with a superuser's X-API-Key.
+    """
+    if not TIMING_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -55,10 +55,9 @@ api_router.include_router(
 
 @api_router.post("/auth/api_key", tags=["auth"])
 async def generate_api_key(user: User = Depends(current_active_user), db: AsyncSession = Depends(get_async_session)):
-    if user.api_key:
-        await delete_api_key(db, user)
-    await create_api_key(db, user)
-    return {"message": "Successfully created an API key!"}
+    await delete_api_key(db, user)
+    _, key = await create_api_key(db, user)
+    return {"message": "Successfully created an API key!", "api_key": key}
 
 
 @api_router.post("/auth/zendesk", tags=["auth"])
@@ -1,64 +1,124 @@
+import datetime
+import logging
 import os
 import uuid
 
-from fastapi import APIRouter, Depends
-import gantry
-import openai
-import pinecone
-from sentence_transformers import SentenceTransformer
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api.deps import (
     current_active_user,
     get_async_session,
+    get_http_client,
+)
+from app.core.cache import TTLCache
+from app.core.clients import create_completion, encode_query, environment, get_gantry, query_index
+from app.core.tickets import get_ticket, get_user_integration
+from app.core.timing import stage
+from app.crud.search_event import (
+    get_daily_rollups,
+    get_team_user_ids,
+    get_top_docs,
+    get_zero_result_queries,
+    record_feedback,
+    record_search,
+    utc_today,
 )
 from app.crud.source import get_sources
+from app.db.session import async_session_maker
 from app.models.user import User
 from app.schemas.search import Event, SearchResponse
 
-PINECONE_KEY = os.getenv("PINECONE_KEY")
-environment = os.getenv("ENVIRONMENT")
-pinecone.init(api_key=PINECONE_KEY, environment="us-west1-gcp")
-index = pinecone.Index(index_name="semantic-text-search")
-openai.api_key = os.getenv("OPENAI_API_KEY")
-search_model = SentenceTransformer("/mnt/bi_encoder")
-gantry.init(
-    api_key=os.getenv("GANTRY_API_KEY"),
-    environment=os.getenv("ENVIRONMENT")
-)
-
 api_router = APIRouter()
+logger = logging.getLogger(__name__)
 
+# The encoder truncates long inputs anyway; keep the subject and the start of the description.
+MAX_TICKET_QUERY_CHARS = 1000
+ticket_search_cache = TTLCache(maxsize=2000, ttl=int(os.getenv("TICKET_SEARCH_CACHE_TTL", 3600)))
 
-@api_router.get("/search", tags=["search"], response_model=SearchResponse)
-async def search(
+
+async def store_search_event(user_id, query_id, query, log_id, results):
+    try:
+        async with async_session_maker() as session:
+            await record_search(session, user_id, query_id, query, log_id, results)
+    except Exception as e:
+        logger.error(f"Failed to store search event: {e}")
+
+
+async def store_feedback_event(user_id, query_id, event_type, message):
+    try:
+        async with async_session_maker() as session:
+            await record_feedback(session, user_id, query_id, event_type, message)
+    except Exception as e:
+        logger.error(f"Failed to store feedback event: {e}")
+
+
+def log_search(background_tasks: BackgroundTasks, user_id: str, query: str, log_id: str, results: list) -> str:
+    """Log a search to gantry and the local event store. Returns its new query_id."""
+    query_id = str(uuid.uuid4())
+    if results:
+        with stage("telemetry"):
+            get_gantry().log_record(
+                application="search_endpoint",
+                version=0,
+                inputs={
+                    "query": query,
+                    "user_id": user_id,
+                    "log_id": log_id
+                },
+                outputs={
+                    "first_result_score": results[0]["score"],
+                    "first_result_doc_name": results[0]["doc_name"],
+                    "first_result_doc_url": results[0]["doc_url"],
+                },
+                feedback_id={"id": query_id}
+            )
+    background_tasks.add_task(store_search_event, user_id, query_id, query, log_id, results)
+    return query_id
+
+
+async def get_team(db: AsyncSession, user: User):
+    """Ids of every user who shares a source with this user, including the user."""
+    sources = await get_sources(db, str(user.id), user.email)
+    owners = {str(user.id)} | {str(source.owner) for source in sources}
+    emails = {user.email} | {email for source in sources for email in (source.shared_with or [])}
+    return await get_team_user_ids(db, list(owners), list(emails))
+
+
+async def run_search(
+    db: AsyncSession,
+    user: User,
     query: str,
+    background_tasks: BackgroundTasks,
     doc_type: str = None,
-    user: User = Depends(current_active_user),
-    db: AsyncSession = Depends(get_async_session),
     count: int = 10,
     log_id: str = None
 ):
     user_id = str(user.id)
     user_email = user.email
-    source_ids = [str(source.id) for source in await get_sources(db, user_id, user_email)]
+    with stage("acl"):
+        source_ids = [str(source.id) for source in await get_sources(db, user_id, user_email)]
     filter = {"source_id": {"$in": source_ids}}
     if doc_type:
         filter["doc_type"] = {"$eq": doc_type}
-    query_embedding = search_model.encode([query])
-    query_results = index.query(
-        queries=[query_embedding.tolist()],
-        top_k=count,
-        filter=filter,
-        include_metadata=True,
-        include_values=False,
-        namespace=environment
-    )
+    with stage("encode"):
+        query_embedding = await run_in_threadpool(encode_query, query)
+    with stage("index_query"):
+        query_results = await run_in_threadpool(
+            query_index,
+            queries=[query_embedding.tolist()],
+            top_k=count,
+            filter=filter,
+            include_metadata=True,
+            include_values=False,
+            namespace=environment
+        )
     matches = query_results["results"][0]["matches"]
-    query_id = str(uuid.uuid4())
     results = {
         "query": query,
-        "query_id": query_id,
+        "query_id": None,
         "count": len(matches),
         "results": [],
         "answer": None
@@ -69,15 +129,17 @@ async def search(
         if results["answer"] is None and len(matches) > 0:
             prompt = "Answer the question based on the context below, and if the question can't be answered based on the context, say \"I don't know\"\n\nContext:\n{0}\n\n---\n\nQuestion: {1}\nAnswer:"
             try:
-                response = openai.Completion.create(
-                    engine="text-curie-001",
-                    prompt=prompt.format(metadata["text"], query),
-                    temperature=0,
-                    max_tokens=100,
-                    top_p=1,
-                    frequency_penalty=0,
-                    presence_penalty=0
-                )
+                with stage("openai"):
+                    response = await run_in_threadpool(
+                        create_completion,
+                        engine="text-curie-001",
+                        prompt=prompt.format(metadata["text"], query),
+                        temperature=0,
+                        max_tokens=100,
+                        top_p=1,
+                        frequency_penalty=0,
+                        presence_penalty=0
+                    )
                 results["answer"] = response.choices[0]["text"].strip()
                 if results["answer"].startswith("I don't know"):
                     results["answer"] = None
@@ -88,35 +150,114 @@ async def search(
             "doc_name": metadata["doc_name"],
             "doc_last_updated": str(metadata["doc_last_updated"]),
             "doc_url": metadata["doc_url"],
-            "text": metadata["text"]
+            "text": metadata["text"],
+            "doc_refs": metadata.get("doc_refs", [])
         }
         results["results"].append(result)
 
-    if matches:
-        gantry.log_record(
-            application="search_endpoint",
-            version=0,
-            inputs={
-                "query": query,
-                "user_id": user_id,
-                "log_id": log_id
-            },
-            outputs={
-                "first_result_score": matches[0]["score"],
-                "first_result_doc_name": matches[0]["metadata"]["doc_name"],
-                "first_result_doc_url": matches[0]["metadata"]["doc_url"],
-            },
-            feedback_id={"id": query_id}
-        )
+    results["query_id"] = log_search(background_tasks, user_id, query, log_id, results["results"])
+    return results
+
+
+@api_router.get("/search", tags=["search"], response_model=SearchResponse)
+async def search(
+    query: str,
+    background_tasks: BackgroundTasks,
+    doc_type: str = None,
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+    count: int = 10,
+    log_id: str = None
+):
+    return await run_search(db, user, query, background_tasks, doc_type=doc_type, count=count, log_id=log_id)
+
+
+@api_router.get("/search/ticket/{ticket_id}", tags=["search"], response_model=SearchResponse)
+async def search_ticket(
+    ticket_id: int,
+    background_tasks: BackgroundTasks,
+    source: str = "zendesk",
+    doc_type: str = None,
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+    http: httpx.AsyncClient = Depends(get_http_client),
+    count: int = 10,
+):
+    """Search with a query built from the ticket's subject and description.
+
+    Results are cached per user and ticket until the ticket's updated_at changes.
+    """
+    if source not in ["zendesk", "hubspot"]:
+        raise HTTPException(status_code=400, detail="source must be zendesk or hubspot")
+    integration = await get_user_integration(db, user, f"{source}_integration")
+    with stage("ticket_fetch"):
+        ticket = await get_ticket(http, integration, ticket_id)
+    if ticket is None:
+        raise HTTPException(status_code=404, detail="ticket not found")
+    key = (str(user.id), str(integration.id), ticket_id, ticket["updated_at"], doc_type, count)
+    results = ticket_search_cache.get(key)
+    if results is None:
+        query = f"{ticket['subject']}. {ticket['description']}"[:MAX_TICKET_QUERY_CHARS]
+        results = await run_search(db, user, query, background_tasks, doc_type=doc_type, count=count, log_id=str(ticket_id))
+        ticket_search_cache.set(key, results)
+    else:
+        # A cached answer is still a search, so it gets its own query_id and event.
+        query_id = log_search(background_tasks, str(user.id), results["query"], str(ticket_id), results["results"])
+        results = {**results, "query_id": query_id}
     return results
 
 
 @api_router.post("/log", tags=["search"])
-async def log(event: Event, user: User = Depends(current_active_user)):
-    gantry.log_record(
+async def log(event: Event, background_tasks: BackgroundTasks, user: User = Depends(current_active_user)):
+    get_gantry().log_record(
         application="search_endpoint",
         version=0,
         feedback_id={"id": event.query_id},
         feedback={"event_type": event.event_type, "message": event.message}
     )
-    return {"message": "success"}
\ No newline at end of file
+    background_tasks.add_task(store_feedback_event, str(user.id), event.query_id, event.event_type, event.message)
+    return {"message": "success"}
+
+
+@api_router.get("/search/analytics/daily", tags=["search"])
+async def search_daily_analytics(
+    days: int = 30,
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+):
+    start = utc_today() - datetime.timedelta(days=days)
+    rollups = await get_daily_rollups(db, await get_team(db, user), start)
+    return [
+        {
+            "day": str(rollup.day),
+            "query_count": rollup.query_count,
+            "zero_result_count": rollup.zero_result_count,
+            "feedback_count": rollup.feedback_count
+        } for rollup in rollups
+    ]
+
+
+@api_router.get("/search/analytics/top_docs", tags=["search"])
+async def search_top_docs(
+    days: int = 30,
+    limit: int = 10,
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+):
+    start = utc_today() - datetime.timedelta(days=days)
+    docs = await get_top_docs(db, await get_team(db, user), start, limit)
+    return [
+        {"doc_url": doc.doc_url, "doc_name": doc.doc_name, "hit_count": doc.hit_count} for doc in docs
+    ]
+
+
+@api_router.get("/search/analytics/zero_results", tags=["search"])
+async def search_zero_results(
+    days: int = 30,
+    limit: int = 20,
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+):
+    start = utc_today() - datetime.timedelta(days=days)
+    queries = await get_zero_result_queries(db, await get_team(db, user), start, limit)
+    return [{"query": query.query, "count": query.count} for query in queries]
\ No newline at end of file
@@ -1,23 +1,66 @@
+import asyncio
+import base64
+import csv
 import datetime
+import hashlib
+import hmac
+import io
 import json
+import logging
 import os
+import time
+from typing import List
+import uuid
 
-import boto3
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import FileResponse
-import gantry.query as gquery
-import pandas as pd
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
-import requests
 
-from app.api.deps import current_active_user, get_async_session
-from app.crud.source import create_source, get_source, get_sources, update_source
+from app.api.deps import current_active_user, get_async_session, get_http_client
+from app.core.aws import invoke_scheduler
+from app.core.clients import environment, get_gantry_query
+from app.core.tickets import get_ticket_subjects, get_user_integration
+from app.crud.search_event import get_first_search_time, get_search_events, get_team_user_ids
+from app.crud.source import (
+    add_source_webhook_doc_types,
+    create_source,
+    get_hubspot_source_by_portal_id,
+    get_source,
+    get_source_by_id,
+    get_sources,
+    set_source_extra_value,
+    update_source,
+)
+from app.crud.ticket_metric import get_ticket_metrics, store_ticket_metrics
 from app.models.user import User
+from app.schemas.source import ZendeskWebhookSecret
 
 api_router = APIRouter()
+logger = logging.getLogger(__name__)
+
+METRICS_CONCURRENCY = int(os.getenv("METRICS_CONCURRENCY", 10))
+REPORT_COLUMNS = [
+    "timestamp",
+    "query",
+    "inputs.user_id",
+    "ticket_id",
+    "first_result_doc_name",
+    "first_result_doc_url",
+]
+WEBHOOK_TOLERANCE_SECONDS = 300
+ZENDESK_ARTICLE_EVENTS = {"zen:event-type:article.published"}
+ZENDESK_ARTICLE_REMOVED_EVENTS = {"zen:event-type:article.unpublished"}
+
 
 @api_router.get("/sources/zendesk/oauth_redirect", tags=["sources"])
-async def zendesk_oauth_redirect(code: str, state: str, db: AsyncSession = Depends(get_async_session)):
+async def zendesk_oauth_redirect(
+    code: str,
+    state: str,
+    db: AsyncSession = Depends(get_async_session),
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
     user_id, subdomain = state.split("|")
     parameters = {
         "grant_type": "authorization_code",
@@ -31,13 +74,13 @@ async def zendesk_oauth_redirect(code: str, state: str, db: AsyncSession = Depen
     payload = json.dumps(parameters)
     header = {"Content-Type": "application/json"}
     url = f"https://{subdomain}/oauth/tokens"
-    r = requests.post(url=url, data=payload, headers=header)
+    r = await http.post(url=url, content=payload, headers=header)
     data = r.json()
     access_token = data["access_token"]
     bearer_token = f"Bearer {access_token}"
     header = {'Authorization': bearer_token}
     url = f"https://{subdomain}/api/v2/users.json?page[size]=100&role[]=agent&role[]=admin"
-    r = requests.get(url, headers=header)
+    r = await http.get(url, headers=header)
     user_emails = [r["email"] for r in r.json().get("users", [])]
     source = await get_source(db, user_id, "zendesk_integration")
     if source:
@@ -48,17 +91,17 @@ async def zendesk_oauth_redirect(code: str, state: str, db: AsyncSession = Depen
     else:
         extra = json.dumps({"access_token": access_token, "subdomain": subdomain})
         source = await create_source(db, user_id, "zendesk_integration", user_emails, extra=extra)
-    lambda_client = boto3.client("lambda", region_name="us-east-1")
-    lambda_client.invoke(
-        FunctionName=os.getenv("SCHEDULER_FUNCTION"),
-        Payload=json.dumps({"source_id": str(source.id)}),
-        InvocationType="Event"
-    )
+    await invoke_scheduler(str(source.id))
     return {"message": "success"}
 
 
 @api_router.get("/sources/hubspot/oauth_redirect", tags=["sources"])
-async def hubspot_oauth_redirect(code: str, state: str, db: AsyncSession = Depends(get_async_session)):
+async def hubspot_oauth_redirect(
+    code: str,
+    state: str,
+    db: AsyncSession = Depends(get_async_session),
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
     user_id, subdomain = state.split("|")
     scope = "content%20tickets%20settings.users.read%20cms.knowledge_base.articles.read%20settings.users.teams.read"
     client_id = os.getenv("HUBSPOT_CLIENT_ID")
@@ -72,33 +115,212 @@ async def hubspot_oauth_redirect(code: str, state: str, db: AsyncSession = Depen
         "redirect_uri": redirect_uri
     }
     url = "https://api.hubapi.com/oauth/v1/token"
-    r = requests.post(url=url, data=parameters)
+    r = await http.post(url=url, data=parameters)
     data = r.json()
     access_token = data["access_token"]
     refresh_token = data["refresh_token"]
     bearer_token = f"Bearer {access_token}"
     header = {'Authorization': bearer_token}
     url = "https://api.hubapi.com/settings/v3/users/"
-    response = requests.get(url, headers=header).json()
+    response = (await http.get(url, headers=header)).json()
     user_emails = [r["email"] for r in response.get("results", [])]
+    portal_id = (await http.get("https://api.hubapi.com/account-info/v3/details", headers=header)).json()["portalId"]
     source = await get_source(db, user_id, "hubspot_integration")
     if source:
         extra = json.loads(source.extra).copy()
-        extra.update({"subdomain": subdomain, "refresh_token": refresh_token})
+        extra.update({"subdomain": subdomain, "refresh_token": refresh_token, "portal_id": portal_id})
         extra_str = json.dumps(extra)
         source = await update_source(db, str(source.id), {"extra": extra_str, "shared_with": user_emails})
     else:
-        extra = json.dumps({"subdomain": subdomain, "refresh_token": refresh_token})
+        extra = json.dumps({"subdomain": subdomain, "refresh_token": refresh_token, "portal_id": portal_id})
         source = await create_source(db, user_id, "hubspot_integration", user_emails, extra=extra)
-    lambda_client = boto3.client("lambda", region_name="us-east-1")
-    lambda_client.invoke(
-        FunctionName=os.getenv("SCHEDULER_FUNCTION"),
-        Payload=json.dumps({"source_id": str(source.id)}),
-        InvocationType="Event"
-    )
+    await invoke_scheduler(str(source.id))
+    return {"message": "success"}
+
+
+def verify_zendesk_signature(secret: str, body: bytes, signature: str, timestamp: str) -> bool:
+    try:
+        sent = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    if sent.tzinfo is None:
+        sent = sent.replace(tzinfo=datetime.timezone.utc)
+    if abs(time.time() - sent.timestamp()) > WEBHOOK_TOLERANCE_SECONDS:
+        return False
+    digest = hmac.new(secret.encode(), timestamp.encode() + body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), signature)
+
+
+def verify_hubspot_signature(
+    secret: str, method: str, uri: str, body: bytes, signature: str, timestamp: str
+) -> bool:
+    try:
+        sent = int(timestamp)
+    except ValueError:
+        return False
+    if abs(time.time() * 1000 - sent) > WEBHOOK_TOLERANCE_SECONDS * 1000:
+        return False
+    message = method.encode() + uri.encode() + body + timestamp.encode()
+    digest = hmac.new(secret.encode(), message, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), signature)
+
+
+def utc_timestamp(dt: datetime.datetime = None) -> str:
+    dt = dt or datetime.datetime.now(datetime.timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def zendesk_webhook_document(source, event):
+    """Map a Zendesk webhook event to a worker document descriptor, if it should be indexed or removed.
+
+    Article events are Zendesk event-subscription webhooks. An unpublished
+    article gets a descriptor marked deleted, and the worker removes it from
+    the index. Ticket events come from a trigger whose JSON body has
+    ticket_id, subject, status and updated_at. As with polling, only solved or
+    closed tickets are indexed.
+    """
+    document = {"owner": str(source.owner), "source_id": str(source.id)}
+    event_type = event.get("type", "")
+    if event_type in ZENDESK_ARTICLE_EVENTS or event_type in ZENDESK_ARTICLE_REMOVED_EVENTS:
+        if event_type in ZENDESK_ARTICLE_REMOVED_EVENTS:
+            document["deleted"] = True
+        document.update({
+            "doc_type": "zendesk_help_center_article",
+            "doc_id": int(event["detail"]["id"]),
+            "doc_name": event.get("event", {}).get("title", ""),
+            "doc_last_updated": event.get("time") or utc_timestamp(),
+        })
+        return document
+    if event.get("ticket_id") and str(event.get("status", "")).lower() in ["solved", "closed"]:
+        document.update({
+            "doc_type": "zendesk_ticket",
+            "doc_id": int(event["ticket_id"]),
+            "doc_name": event.get("subject", ""),
+            "doc_last_updated": event.get("updated_at") or utc_timestamp(),
+        })
+        return document
+    return None
+
+
+async def enqueue_webhook_documents(db: AsyncSession, source, documents):
+    extra = json.loads(source.extra) if source.extra else {}
+    doc_types = {document["doc_type"] for document in documents}
+    if not doc_types.issubset(extra.get("webhook_doc_types", [])):
+        # Lets the scheduler fall back to a slow reconciliation poll for these doc types only.
+        # Updated in place, as the scheduler may be writing its cursors to extra meanwhile.
+        await add_source_webhook_doc_types(db, str(source.id), sorted(doc_types))
+    if documents:
+        # The scheduler claims them in the pending ledger and enqueues them.
+        await invoke_scheduler(str(source.id), documents)
+    return len(documents)
+
+
+def parse_webhook_body(body: bytes):
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid webhook body")
+
+
+@api_router.post("/sources/zendesk/webhook_secret", tags=["sources"])
+async def set_zendesk_webhook_secret(
+    webhook_secret: ZendeskWebhookSecret,
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+):
+    """Store the signing secret of the Zendesk webhook that posts to this user's source."""
+    source = await get_source(db, str(user.id), "zendesk_integration")
+    if source is None:
+        raise HTTPException(status_code=404, detail="zendesk source not found")
+    await set_source_extra_value(db, str(source.id), "webhook_secret", webhook_secret.secret)
     return {"message": "success"}
 
 
+@api_router.post("/sources/zendesk/webhook/{source_id}", tags=["sources"])
+async def zendesk_webhook(
+    source_id: uuid.UUID,
+    request: Request,
+    x_zendesk_webhook_signature: str = Header(None),
+    x_zendesk_webhook_signature_timestamp: str = Header(None),
+    db: AsyncSession = Depends(get_async_session),
+):
+    body = await request.body()
+    source = await get_source_by_id(db, str(source_id))
+    if source is not None and source.name != "zendesk_integration":
+        source = None
+    extra = json.loads(source.extra) if source and source.extra else {}
+    # Each source's webhook has its own signing secret, stored with set_zendesk_webhook_secret.
+    secret = extra.get("webhook_secret")
+    # An unknown source, or one without a secret, gets the same 401 as a bad
+    # signature, so source ids cannot be probed.
+    if not (
+        source
+        and secret
+        and x_zendesk_webhook_signature
+        and x_zendesk_webhook_signature_timestamp
+        and verify_zendesk_signature(secret, body, x_zendesk_webhook_signature, x_zendesk_webhook_signature_timestamp)
+    ):
+        raise HTTPException(status_code=401, detail="invalid webhook signature")
+    payload = parse_webhook_body(body)
+    events = payload if isinstance(payload, list) else [payload]
+    documents = [zendesk_webhook_document(source, event) for event in events]
+    documents = [document for document in documents if document]
+    received = await enqueue_webhook_documents(db, source, documents)
+    return {"message": "success", "received": received}
+
+
+@api_router.post("/sources/hubspot/webhook", tags=["sources"])
+async def hubspot_webhook(
+    request: Request,
+    x_hubspot_signature_v3: str = Header(None),
+    x_hubspot_request_timestamp: str = Header(None),
+    db: AsyncSession = Depends(get_async_session),
+):
+    body = await request.body()
+    uri = os.getenv("HUBSPOT_WEBHOOK_URL") or str(request.url)
+    if not (
+        x_hubspot_signature_v3
+        and x_hubspot_request_timestamp
+        and verify_hubspot_signature(
+            os.getenv("HUBSPOT_SECRET", ""),
+            request.method,
+            uri,
+            body,
+            x_hubspot_signature_v3,
+            x_hubspot_request_timestamp,
+        )
+    ):
+        raise HTTPException(status_code=401, detail="invalid webhook signature")
+    # Subscribed to ticket.propertyChange on closed_date, so each event is a ticket being closed.
+    events_by_portal = {}
+    for event in parse_webhook_body(body):
+        if event.get("subscriptionType") != "ticket.propertyChange":
+            continue
+        if event.get("propertyName") != "closed_date" or not event.get("propertyValue"):
+            continue
+        events_by_portal.setdefault(str(event["portalId"]), []).append(event)
+    received = 0
+    for portal_id, events in events_by_portal.items():
+        source = await get_hubspot_source_by_portal_id(db, portal_id)
+        if source is None:
+            continue
+        documents = [
+            {
+                "owner": str(source.owner),
+                "doc_type": "hubspot_ticket",
+                "portal_id": int(portal_id),
+                "doc_id": str(event["objectId"]),
+                "doc_name": "",
+                "doc_last_updated": utc_timestamp(
+                    datetime.datetime.fromtimestamp(event["occurredAt"] / 1000, datetime.timezone.utc)
+                ),
+                "source_id": str(source.id),
+            } for event in events
+        ]
+        received += await enqueue_webhook_documents(db, source, documents)
+    return {"message": "success", "received": received}
+
+
 @api_router.get("/sources/me", tags=["sources"])
 async def get_zendesk_user_source(
     user: User = Depends(current_active_user),
@@ -144,56 +366,59 @@ async def get_zendesk_user_source(
     }
 
 
+@api_router.get("/sources/zendesk/tickets", tags=["sources"])
+async def get_zendesk_ticket_subjects(
+    ids: List[int] = Query(...),
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
+    source = await get_user_integration(db, user, "zendesk_integration")
+    subjects = await get_ticket_subjects(http, source, ids)
+    return {"ticket_subjects": subjects}
+
+
 @api_router.get("/sources/zendesk/tickets/{ticket_id}", tags=["sources"])
 async def get_zendesk_ticket_subject(
     ticket_id: int,
     user: User = Depends(current_active_user),
     db: AsyncSession = Depends(get_async_session),
-):  
-    sources = await get_sources(db, str(user.id), user.email)
-    source = [source for source in sources if source.name == "zendesk_integration"][0]
-    if source is None:
-        raise HTTPException(status_code=404, detail="zendesk source not found")
-    extra = json.loads(source.extra)
-    access_token = extra["access_token"]
-    bearer_token = f"Bearer {access_token}"
-    header = {'Authorization': bearer_token}
-    subdomain = extra["subdomain"]
-    data = requests.get(f"https://{subdomain}/api/v2/tickets/{ticket_id}", headers=header).json()
-    ticket_subject = data["ticket"]["subject"]
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
+    source = await get_user_integration(db, user, "zendesk_integration")
+    subjects = await get_ticket_subjects(http, source, [ticket_id])
+    if ticket_id not in subjects:
+        raise HTTPException(status_code=404, detail="ticket not found")
     return {
-        "ticket_subject": ticket_subject
+        "ticket_subject": subjects[ticket_id]
     }
 
 
+@api_router.get("/sources/hubspot/tickets", tags=["sources"])
+async def get_hubspot_ticket_subjects(
+    ids: List[int] = Query(...),
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
+    source = await get_user_integration(db, user, "hubspot_integration")
+    subjects = await get_ticket_subjects(http, source, ids)
+    return {"ticket_subjects": subjects}
+
+
 @api_router.get("/sources/hubspot/tickets/{ticket_id}", tags=["sources"])
 async def get_hubspot_ticket_subject(
     ticket_id: int,
     user: User = Depends(current_active_user),
     db: AsyncSession = Depends(get_async_session),
-):  
-    sources = await get_sources(db, str(user.id), user.email)
-    source = [source for source in sources if source.name == "hubspot_integration"][0]
-    if source is None:
-        raise HTTPException(status_code=404, detail="hubspot source not found")
-    extra = json.loads(source.extra)
-    refresh_token = extra["refresh_token"]
-    parameters = {
-        "grant_type": "refresh_token",
-        "client_id": os.getenv("HUBSPOT_CLIENT_ID"),
-        "client_secret": os.getenv("HUBSPOT_SECRET"),
-        "redirect_uri": os.getenv("HUBSPOT_REDIRECT_URI"),
-        "refresh_token": refresh_token
-    }
-    r = requests.post("https://api.hubapi.com/oauth/v1/token", data=parameters)
-    data = r.json()
-    access_token = data["access_token"]
-    bearer_token = f"Bearer {access_token}"
-    header = {'Authorization': bearer_token}
-    response = requests.get(f"https://api.hubapi.com/crm/v3/objects/tickets/{ticket_id}", headers=header).json()
-    ticket_subject = response["properties"]["subject"]
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
+    source = await get_user_integration(db, user, "hubspot_integration")
+    subjects = await get_ticket_subjects(http, source, [ticket_id])
+    if ticket_id not in subjects:
+        raise HTTPException(status_code=404, detail="ticket not found")
     return {
-        "ticket_subject": ticket_subject
+        "ticket_subject": subjects[ticket_id]
     }
 
 
@@ -212,28 +437,65 @@ async def get_zendesk_user_source(
     }
 
 
-@api_router.get("/sources/zendesk/analytics", tags=["sources"])
-async def get_zendesk_user_source(
-    user: User = Depends(current_active_user),
-    db: AsyncSession = Depends(get_async_session)
-):
-    gquery.init(api_key=os.getenv("GANTRY_API_KEY"))
-    source = await get_source(db, str(user.id), "zendesk_integration")
-    extra = json.loads(source.extra)
-    access_token = extra["access_token"]
-    subdomain = extra["subdomain"]
-    bearer_token = f"Bearer {access_token}"
-    header = {'Authorization': bearer_token}
-    current = datetime.datetime.now()
-    start = current - datetime.timedelta(days=30)
-    gdf = gquery.query(
+def parse_ticket_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_final_ticket_metric(status, ticket_metric):
+    """Whether a ticket's metrics can no longer change.
+
+    Only closed tickets qualify. Solved tickets can still be reopened until
+    Zendesk closes them.
+    """
+    return status == "closed" and bool(ticket_metric.get("solved_at"))
+
+
+async def fetch_ticket_metrics(http, subdomain, header, ticket_ids):
+    """Fetch each ticket's status and metrics, at most METRICS_CONCURRENCY at a time.
+
+    Throttled and unavailable responses are retried by the client's transport,
+    which honors Retry-After. Tickets that still fail are logged and left out,
+    so one bad ticket does not fail the whole report.
+    """
+    semaphore = asyncio.Semaphore(METRICS_CONCURRENCY)
+
+    async def fetch(ticket_id):
+        async with semaphore:
+            response = await http.get(
+                f"https://{subdomain}/api/v2/tickets/{ticket_id}.json",
+                params={"include": "metric_sets"},
+                headers=header,
+            )
+        response.raise_for_status()
+        data = response.json()
+        metric_sets = data.get("metric_sets") or [{}]
+        return ticket_id, data["ticket"].get("status"), metric_sets[0]
+
+    results = await asyncio.gather(*[fetch(ticket_id) for ticket_id in ticket_ids], return_exceptions=True)
+    fetched = []
+    for ticket_id, result in zip(ticket_ids, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to fetch metrics for ticket {ticket_id}: {result!r}")
+            continue
+        fetched.append(result)
+    return fetched
+
+
+def get_gantry_search_events(user_ids, start, end):
+    """Search events logged to gantry between start and end, as report rows. Blocking."""
+    gdf = get_gantry_query().query(
         application="search_endpoint",
         version=0,
-        environment=os.getenv("ENVIRONMENT"),
-        end_time=current.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-        start_time=start.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        environment=environment,
+        start_time=start.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        end_time=end.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
     )
     df = gdf.fetch().reset_index()
+    if df.empty:
+        return []
     columns = [
         "timestamp",
         "inputs.query",
@@ -242,31 +504,74 @@ async def get_zendesk_user_source(
         "outputs.first_result_doc_name",
         "outputs.first_result_doc_url"
     ]
-    filtered_df = df[columns].copy()
-    filtered_df.rename(
-        columns={
-            "inputs.log_id": "ticket_id",
-            "inputs.query": "query",
-            "outputs.first_result_doc_name": "first_result_doc_name",
-            "outputs.first_result_doc_url": "first_result_doc_url"
-        },
-        inplace=True
-    )
-    filtered_df["ticket_id"] = filtered_df["ticket_id"].astype("Int64")
-    unique_ticket_ids = filtered_df["ticket_id"].dropna().unique().tolist()
-    metrics = []
-    for ticket_id in unique_ticket_ids:
-        data = requests.get(f"https://{subdomain}/api/v2/tickets/{ticket_id}/metrics", headers=header).json()
-        ticket_metric = data.get("ticket_metric", {})
+    df = df[df["inputs.user_id"].astype(str).isin(user_ids)]
+    return list(df[columns].itertuples(index=False, name=None))
+
+
+def iter_report_csv(rows, metrics):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REPORT_COLUMNS + ["first_resolution_time_in_minutes", "full_resolution_time_in_minutes"])
+    ticket_id_index = REPORT_COLUMNS.index("ticket_id")
+    for row in rows:
+        row = list(row)
+        ticket_id = row[ticket_id_index] = parse_ticket_id(row[ticket_id_index])
+        writer.writerow(row + list(metrics.get(ticket_id, (None, None))))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+@api_router.get("/sources/zendesk/analytics", tags=["sources"])
+async def get_zendesk_user_source(
+    user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_session),
+    http: httpx.AsyncClient = Depends(get_http_client),
+):
+    source = await get_source(db, str(user.id), "zendesk_integration")
+    extra = json.loads(source.extra)
+    access_token = extra["access_token"]
+    subdomain = extra["subdomain"]
+    bearer_token = f"Bearer {access_token}"
+    header = {'Authorization': bearer_token}
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30)
+    user_ids = await get_team_user_ids(db, [str(source.owner)], source.shared_with or [])
+    rows = [tuple(event) for event in await get_search_events(db, user_ids, start)]
+    # Searches from before events were stored locally are read back from gantry.
+    first_search = await get_first_search_time(db)
+    end = first_search or datetime.datetime.now(datetime.timezone.utc)
+    if end > start:
+        try:
+            rows = await run_in_threadpool(get_gantry_search_events, user_ids, start, end) + rows
+        except Exception as e:
+            logger.warning(f"Failed to read search events from gantry: {e!r}")
+    ticket_id_index = REPORT_COLUMNS.index("ticket_id")
+    unique_ticket_ids = list({
+        ticket_id for ticket_id in (parse_ticket_id(row[ticket_id_index]) for row in rows)
+        if ticket_id is not None
+    })
+    cached = await get_ticket_metrics(db, str(source.id), unique_ticket_ids)
+    metrics = {
+        ticket_id: (metric.first_resolution_time_in_minutes, metric.full_resolution_time_in_minutes)
+        for ticket_id, metric in cached.items()
+    }
+    missing_ticket_ids = [ticket_id for ticket_id in unique_ticket_ids if ticket_id not in cached]
+    final_metrics = []
+    for ticket_id, status, ticket_metric in await fetch_ticket_metrics(http, subdomain, header, missing_ticket_ids):
         first_resolution_time_in_minutes = ticket_metric.get("first_resolution_time_in_minutes", {}).get("business")
         full_resolution_time_in_minutes = ticket_metric.get("full_resolution_time_in_minutes", {}).get("business")
         if first_resolution_time_in_minutes and full_resolution_time_in_minutes:
-            metrics.append([ticket_id, first_resolution_time_in_minutes, full_resolution_time_in_minutes])
-    metrics_df = pd.DataFrame(
-        data=metrics,
-        columns=["ticket_id", "first_resolution_time_in_minutes", "full_resolution_time_in_minutes"]
-    )
-    metrics_df["ticket_id"] = metrics_df["ticket_id"].astype("Int64")
-    joined_df = pd.merge(filtered_df, metrics_df, how="left", on="ticket_id")
-    joined_df.to_csv("/tmp/report.csv", index=False)
-    return FileResponse(path="/tmp/report.csv", filename="report.csv", media_type="text/csv")
\ No newline at end of file
+            metrics[ticket_id] = (first_resolution_time_in_minutes, full_resolution_time_in_minutes)
+        if is_final_ticket_metric(status, ticket_metric):
+            final_metrics.append({
+                "ticket_id": ticket_id,
+                "first_resolution_time_in_minutes": first_resolution_time_in_minutes,
+                "full_resolution_time_in_minutes": full_resolution_time_in_minutes,
+                "solved_at": datetime.datetime.fromisoformat(ticket_metric["solved_at"].replace("Z", "+00:00")),
+            })
+    await store_ticket_metrics(db, str(source.id), final_metrics)
+    return StreamingResponse(
+        iter_report_csv(rows, metrics),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="report.csv"'}
+    )
\ No newline at end of file
@@ -1,24 +1,38 @@
 import os
-from typing import AsyncGenerator, Optional
+from typing import Any, AsyncGenerator, Optional
 import uuid
 
+import httpx
 from httpx_oauth.clients.google import GoogleOAuth2
-from fastapi import Depends, Request
+from fastapi import Depends, HTTPException, Request, Response
+from fastapi.security import APIKeyHeader
 from fastapi_users.db import SQLAlchemyUserDatabase
-from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin
+from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin, exceptions
 from fastapi_users.authentication import (
     AuthenticationBackend,
     BearerTransport,
     CookieTransport,
     JWTStrategy,
 )
+from fastapi_users.authentication.strategy import StrategyDestroyNotSupportedError
+from fastapi_users.authentication.transport import TransportLogoutNotSupportedError
+from fastapi_users.jwt import decode_jwt
+import jwt
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 
+from app.core.cache import TTLCache
+from app.crud.api_key import get_api_key_user_id
+from app.core.http import get_client
 from app.db.session import async_session_maker, engine
 from app.db.base_class import Base
 from app.models.user import User, OAuthAccount
 
 SECRET = os.getenv("SECRET")
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+
+principal_cache = TTLCache(maxsize=10000, ttl=PRINCIPAL_CACHE_TTL)
 
 google_oauth_client = GoogleOAuth2(
     os.getenv("GOOGLE_OAUTH_CLIENT_ID", ""),
@@ -42,6 +56,18 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, uuid.UUID]):
     ):
         print(f"Verification requested for user {user.id}. Verification token: {token}")
 
+    async def on_after_update(self, user: User, update_dict: dict, request: Optional[Request] = None):
+        principal_cache.pop(str(user.id))
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None):
+        principal_cache.pop(str(user.id))
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        principal_cache.pop(str(user.id))
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        principal_cache.pop(str(user.id))
+
 
 async def create_db_and_tables():
     async with engine.begin() as conn:
@@ -52,6 +78,10 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+async def get_http_client() -> httpx.AsyncClient:
+    return get_client()
+
+
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
     yield SQLAlchemyUserDatabase(session, User, OAuthAccount)
 
@@ -64,8 +94,91 @@ bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 cookie_transport = CookieTransport(cookie_max_age=3600)
 
 
+async def get_principal(session: AsyncSession, user_id: uuid.UUID) -> Optional[User]:
+    """Load a user for authorization from its own columns only.
+
+    No relationships are joined. The columns are cached for PRINCIPAL_CACHE_TTL
+    seconds, and each request gets its own detached User built from them, so a
+    cache hit does not touch the database. Relationships are not loaded and
+    must be queried explicitly where they are needed.
+    """
+    columns = principal_cache.get(str(user_id))
+    if columns is None:
+        result = await session.execute(select(*User.__table__.columns).where(User.id == user_id))
+        row = result.mappings().first()
+        if row is None:
+            return None
+        columns = dict(row)
+        principal_cache.set(str(user_id), columns)
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return user
+
+
+class PrincipalJWTStrategy(JWTStrategy):
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager) -> Optional[User]:
+        if token is None:
+            return None
+        try:
+            data = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+            # Newer fastapi-users releases put the id in "sub" rather than "user_id".
+            user_id = data.get("user_id") or data.get("sub")
+            if user_id is None:
+                return None
+            user_id = user_manager.parse_id(user_id)
+        except (jwt.PyJWTError, exceptions.InvalidID):
+            return None
+        return await get_principal(user_manager.user_db.session, user_id)
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
+    return PrincipalJWTStrategy(secret=SECRET, lifetime_seconds=3600)
+
+
+class APIKeyTransport:
+    """Reads a key from the X-API-Key header. Keys are issued by
+    /auth/api_key rather than a login route, so there is nothing to log in or
+    out of."""
+
+    scheme: APIKeyHeader
+
+    def __init__(self):
+        self.scheme = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+    async def get_login_response(self, token: str, response: Response) -> Any:
+        raise HTTPException(status_code=405, detail="API keys are issued by /auth/api_key")
+
+    async def get_logout_response(self, response: Response) -> Any:
+        raise TransportLogoutNotSupportedError()
+
+    @staticmethod
+    def get_openapi_login_responses_success():
+        return {}
+
+    @staticmethod
+    def get_openapi_logout_responses_success():
+        return {}
+
+
+class APIKeyStrategy:
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager) -> Optional[User]:
+        if not token:
+            return None
+        session = user_manager.user_db.session
+        user_id = await get_api_key_user_id(session, token)
+        if user_id is None:
+            return None
+        return await get_principal(session, uuid.UUID(str(user_id)))
+
+    async def write_token(self, user: User) -> str:
+        raise HTTPException(status_code=405, detail="API keys are issued by /auth/api_key")
+
+    async def destroy_token(self, token: str, user: User) -> None:
+        raise StrategyDestroyNotSupportedError()
+
+
+def get_api_key_strategy() -> APIKeyStrategy:
+    return APIKeyStrategy()
 
 
 auth_backend = AuthenticationBackend(
@@ -79,6 +192,15 @@ cookie_backend = AuthenticationBackend(
     get_strategy=get_jwt_strategy,
 )
 
-fastapi_users = FastAPIUsers[User, uuid.UUID](get_user_manager, [auth_backend, cookie_backend])
+api_key_backend = AuthenticationBackend(
+    name="api_key",
+    transport=APIKeyTransport(),
+    get_strategy=get_api_key_strategy,
+)
+
+fastapi_users = FastAPIUsers[User, uuid.UUID](
+    get_user_manager, [auth_backend, cookie_backend, api_key_backend]
+)
 
-current_active_user = fastapi_users.current_user(active=True)
\ No newline at end of file
+current_active_user = fastapi_users.current_user(active=True)
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""Fail if importing app.main gets slow or pulls in a heavy dependency.
+
+Imports app.main in a fresh interpreter, as a Lambda cold start does. Exits
+non-zero if that takes longer than IMPORT_TIME_BUDGET_MS or leaves any of
+DEFERRED_MODULES in sys.modules. Those should only load on first use; see
+app.core.clients. On failure the slowest imports from ``python -X importtime``
+are listed.
+
+    python -m app.check_import_time
+"""
+import os
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", 1500))
+DEFERRED_MODULES = [
+    "boto3",
+    "gantry",
+    "openai",
+    "pandas",
+    "pinecone",
+    "sentence_transformers",
+    "torch",
+]
+SLOWEST_IMPORTS = 15
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import app.main
+elapsed = (time.perf_counter() - start) * 1000
+loaded = [name for name in {modules!r} if name in sys.modules]
+print(elapsed)
+print(",".join(loaded))
+"""
+
+
+def get_slowest_imports(stderr: str):
+    """Parse ``-X importtime`` output into (cumulative microseconds, module) pairs."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:SLOWEST_IMPORTS]
+
+
+def main() -> int:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(modules=DEFERRED_MODULES)],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+    elapsed, loaded = result.stdout.splitlines()[-2:]
+    elapsed = float(elapsed)
+    loaded = [name for name in loaded.split(",") if name]
+
+    failed = False
+    print(f"import app.main: {elapsed:.0f}ms (budget {IMPORT_TIME_BUDGET_MS:.0f}ms)")
+    if elapsed > IMPORT_TIME_BUDGET_MS:
+        failed = True
+        print("FAIL import time is over budget")
+    if loaded:
+        failed = True
+        print(f"FAIL loaded at import: {', '.join(loaded)}")
+    if failed:
+        print("slowest imports (cumulative ms):")
+        for cumulative, name in get_slowest_imports(result.stderr):
+            print(f"  {cumulative / 1000:8.1f}  {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
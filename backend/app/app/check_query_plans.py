@@ -0,0 +1,121 @@
+"""Fail if a hot-path query plans a sequential scan.
+
+Seeds the database at SQLALCHEMY_DATABASE_URL (migrated to head) with
+QUERY_PLAN_USERS users, three sources each and QUERY_PLAN_DOCUMENTS documents,
+runs EXPLAIN on the queries the API, scheduler and worker issue most, and rolls
+everything back. Exits non-zero if any of them scans source or document
+sequentially.
+
+    python -m app.check_query_plans
+"""
+import os
+import sys
+from typing import Any, Dict, List
+
+from sqlalchemy import create_engine, or_, select, text
+from sqlalchemy.dialects import postgresql
+
+from app.models.sources import Source
+
+DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL", "").replace("+asyncpg", "")
+QUERY_PLAN_USERS = int(os.getenv("QUERY_PLAN_USERS", 5000))
+QUERY_PLAN_DOCUMENTS = int(os.getenv("QUERY_PLAN_DOCUMENTS", 500000))
+CHECKED_RELATIONS = {"source", "document"}
+
+SEED_STATEMENTS = [
+    """
+    insert into "user" (id, email, hashed_password, is_active, is_superuser, is_verified)
+    select gen_random_uuid(), 'plan-user-' || i || '@example.com', '', true, false, true
+    from generate_series(1, :users) as i
+    """,
+    """
+    insert into source (id, owner, name, shared_with, extra)
+    select gen_random_uuid(), u.id, n.name,
+        array[
+            'plan-user-' || (1 + floor(random() * :users))::int || '@example.com',
+            'plan-user-' || (1 + floor(random() * :users))::int || '@example.com'
+        ],
+        '{}'
+    from "user" u
+    cross join (values ('zendesk_integration'), ('hubspot_integration'), ('google_integration')) as n(name)
+    where u.email like 'plan-user-%'
+    """,
+    """
+    with owners as (
+        select array_agg(id) as ids from "user" where email like 'plan-user-%'
+    )
+    insert into document (id, owner, name, type, doc_id, doc_last_updated, created)
+    select gen_random_uuid(), owners.ids[1 + i % :users], 'Document ' || i,
+        (array['zendesk_help_center_article', 'zendesk_ticket', 'hubspot_help_center_article'])[1 + i % 3],
+        i::text,
+        now() - random() * interval '365 days',
+        now() - random() * interval '365 days'
+    from owners, generate_series(1, :documents) as i
+    """,
+    "analyze \"user\"",
+    "analyze source",
+    "analyze document",
+]
+
+
+def get_queries(user_id: str, email: str) -> Dict[str, Any]:
+    """Queries to check, keyed by where they run. ORM statements are built the
+    same way the crud functions build them."""
+    return {
+        "crud.source.get_sources": select(Source).where(
+            or_(Source.owner == user_id, Source.shared_with.contains([email]))
+        ),
+        "crud.source.get_source": select(Source).where(
+            Source.owner == user_id, Source.name == "zendesk_integration"
+        ),
+        "worker.process_document": text(
+            "select id from document where doc_id = :doc_id and owner = :owner and type = :type"
+        ).bindparams(doc_id="42", owner=user_id, type="zendesk_ticket"),
+        "scheduler.get_hubspot_article_documents": text(
+            "select doc_id, doc_last_updated from document where owner = :owner and type = 'hubspot_help_center_article'"
+        ).bindparams(owner=user_id),
+    }
+
+
+def get_sequential_scans(plan: Dict[str, Any]) -> List[str]:
+    scans = []
+    if plan["Node Type"] == "Seq Scan" and plan.get("Relation Name") in CHECKED_RELATIONS:
+        scans.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans.extend(get_sequential_scans(child))
+    return scans
+
+
+def main() -> int:
+    engine = create_engine(DATABASE_URL)
+    failures = 0
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for statement in SEED_STATEMENTS:
+                connection.execute(
+                    text(statement),
+                    {"users": QUERY_PLAN_USERS, "documents": QUERY_PLAN_DOCUMENTS},
+                )
+            user_id, email = connection.execute(
+                text("select id, email from \"user\" where email like 'plan-user-%' limit 1")
+            ).fetchone()
+            for name, query in get_queries(str(user_id), email).items():
+                compiled = query.compile(dialect=postgresql.psycopg2.dialect())
+                result = connection.exec_driver_sql(
+                    f"explain (format json) {compiled}", compiled.params
+                )
+                plan = result.scalar()[0]["Plan"]
+                scans = get_sequential_scans(plan)
+                if scans:
+                    failures += 1
+                    print(f"FAIL {name}: sequential scan on {', '.join(scans)}")
+                else:
+                    print(f"ok   {name}: {plan['Node Type']}")
+        finally:
+            transaction.rollback()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import json
+import os
+from typing import Any, Dict, List
+
+from fastapi.concurrency import run_in_threadpool
+
+_lambda_client = None
+
+
+def get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        import boto3
+        _lambda_client = boto3.client("lambda", region_name="us-east-1")
+    return _lambda_client
+
+
+async def invoke_scheduler(source_id: str, documents: List[Dict[str, Any]] = None):
+    """Trigger an asynchronous scheduler run for one source without blocking the event loop.
+
+    With documents, the scheduler enqueues just those instead of syncing the source.
+    """
+    body = {"source_id": source_id}
+    if documents is not None:
+        body["documents"] = documents
+    await run_in_threadpool(
+        get_lambda_client().invoke,
+        FunctionName=os.getenv("SCHEDULER_FUNCTION"),
+        # The scheduler reads its parameters from the event body.
+        Payload=json.dumps({"body": json.dumps(body)}),
+        InvocationType="Event"
+    )
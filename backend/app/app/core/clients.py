@@ -0,0 +1,86 @@
+"""Search clients that are created on first use instead of at import.
+
+Importing sentence_transformers, pinecone, openai and gantry (and loading the
+encoder) takes seconds. Deferring it keeps Lambda cold starts cheap for
+requests that never search, such as /health-check and auth. Each getter
+imports and initialises its client once per process. Call the blocking ones
+from a worker thread.
+"""
+import os
+import threading
+
+environment = os.getenv("ENVIRONMENT")
+
+_lock = threading.Lock()
+_search_model = None
+_index = None
+_openai = None
+_gantry = None
+_gantry_query = None
+
+
+def get_search_model():
+    global _search_model
+    if _search_model is None:
+        with _lock:
+            if _search_model is None:
+                from sentence_transformers import SentenceTransformer
+                _search_model = SentenceTransformer("/mnt/bi_encoder")
+    return _search_model
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                import pinecone
+                pinecone.init(api_key=os.getenv("PINECONE_KEY"), environment="us-west1-gcp")
+                _index = pinecone.Index(index_name="semantic-text-search")
+    return _index
+
+
+def get_openai():
+    global _openai
+    if _openai is None:
+        with _lock:
+            if _openai is None:
+                import openai
+                openai.api_key = os.getenv("OPENAI_API_KEY")
+                _openai = openai
+    return _openai
+
+
+def get_gantry():
+    global _gantry
+    if _gantry is None:
+        with _lock:
+            if _gantry is None:
+                import gantry
+                gantry.init(api_key=os.getenv("GANTRY_API_KEY"), environment=environment)
+                _gantry = gantry
+    return _gantry
+
+
+def get_gantry_query():
+    """The gantry.query module, initialised for reading logged records."""
+    global _gantry_query
+    if _gantry_query is None:
+        with _lock:
+            if _gantry_query is None:
+                import gantry.query as gquery
+                gquery.init(api_key=os.getenv("GANTRY_API_KEY"))
+                _gantry_query = gquery
+    return _gantry_query
+
+
+def encode_query(query: str):
+    return get_search_model().encode([query])
+
+
+def query_index(**kwargs):
+    return get_index().query(**kwargs)
+
+
+def create_completion(**kwargs):
+    return get_openai().Completion.create(**kwargs)
@@ -0,0 +1,63 @@
+import asyncio
+import os
+
+import httpx
+
+HTTP_TIMEOUT = httpx.Timeout(float(os.getenv("HTTP_TIMEOUT", 10)), connect=5.0)
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+HTTP_RETRIES = 3
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+RETRY_METHODS = {"GET", "HEAD"}
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """Pooled transport that retries connection failures, plus throttled or unavailable idempotent requests."""
+
+    def __init__(self, retries: int = HTTP_RETRIES, backoff: float = 0.5):
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = httpx.AsyncHTTPTransport(limits=HTTP_LIMITS, retries=retries)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            response = await self.transport.handle_async_request(request)
+            if (
+                request.method not in RETRY_METHODS
+                or response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.retries
+            ):
+                return response
+            await response.aclose()
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+            await asyncio.sleep(min(delay, 10))
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+_client = None
+_client_loop = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the application-wide client, creating it for the running event loop.
+
+    Pooled connections belong to the loop that opened them. If the loop
+    changes, for example between Lambda invocations that use a new loop, a
+    fresh client is created.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(timeout=HTTP_TIMEOUT, transport=RetryTransport())
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
\ No newline at end of file
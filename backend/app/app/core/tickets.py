@@ -0,0 +1,126 @@
+import json
+import os
+from typing import List
+
+from fastapi import HTTPException
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.cache import TTLCache
+from app.crud.source import get_sources
+from app.models.user import User
+
+TICKET_BATCH_SIZE = 100
+
+ticket_cache = TTLCache(maxsize=10000, ttl=int(os.getenv("TICKET_CACHE_TTL", 60)))
+ticket_subject_cache = TTLCache(maxsize=10000, ttl=int(os.getenv("TICKET_CACHE_TTL", 60)))
+hubspot_token_cache = TTLCache(maxsize=1000, ttl=1800)
+
+
+async def get_user_integration(db: AsyncSession, user: User, name: str):
+    """The first source of the given integration the user owns or is shared on, or a 404."""
+    sources = await get_sources(db, str(user.id), user.email)
+    source = next((source for source in sources if source.name == name), None)
+    if source is None:
+        raise HTTPException(status_code=404, detail=f"{name.split('_')[0]} source not found")
+    return source
+
+
+async def get_hubspot_access_token(http: httpx.AsyncClient, source):
+    """Exchange the source's refresh token, reusing the access token until shortly before it expires."""
+    access_token = hubspot_token_cache.get(str(source.id))
+    if access_token:
+        return access_token
+    extra = json.loads(source.extra)
+    parameters = {
+        "grant_type": "refresh_token",
+        "client_id": os.getenv("HUBSPOT_CLIENT_ID"),
+        "client_secret": os.getenv("HUBSPOT_SECRET"),
+        "redirect_uri": os.getenv("HUBSPOT_REDIRECT_URI"),
+        "refresh_token": extra["refresh_token"]
+    }
+    r = await http.post("https://api.hubapi.com/oauth/v1/token", data=parameters)
+    data = r.json()
+    access_token = data["access_token"]
+    hubspot_token_cache.set(str(source.id), access_token, ttl=max(data.get("expires_in", 1800) - 60, 0))
+    return access_token
+
+
+async def get_ticket_subjects(http: httpx.AsyncClient, source, ticket_ids: List[int]):
+    """Map ticket ids to subjects, using cached subjects and one multi-get per 100 misses."""
+    subjects = {}
+    missing = []
+    for ticket_id in dict.fromkeys(ticket_ids):
+        subject = ticket_subject_cache.get((str(source.id), ticket_id))
+        if subject is None:
+            missing.append(ticket_id)
+        else:
+            subjects[ticket_id] = subject
+    extra = json.loads(source.extra)
+    for i in range(0, len(missing), TICKET_BATCH_SIZE):
+        batch = missing[i:i+TICKET_BATCH_SIZE]
+        if source.name == "zendesk_integration":
+            header = {'Authorization': f"Bearer {extra['access_token']}"}
+            ids = ",".join(str(ticket_id) for ticket_id in batch)
+            data = (await http.get(f"https://{extra['subdomain']}/api/v2/tickets/show_many.json?ids={ids}", headers=header)).json()
+            fetched = {ticket["id"]: ticket["subject"] for ticket in data.get("tickets", [])}
+        else:
+            access_token = await get_hubspot_access_token(http, source)
+            header = {'Authorization': f"Bearer {access_token}"}
+            payload = {"properties": ["subject"], "inputs": [{"id": str(ticket_id)} for ticket_id in batch]}
+            data = (await http.post("https://api.hubapi.com/crm/v3/objects/tickets/batch/read", json=payload, headers=header)).json()
+            fetched = {int(ticket["id"]): ticket["properties"]["subject"] for ticket in data.get("results", [])}
+        for ticket_id, subject in fetched.items():
+            ticket_subject_cache.set((str(source.id), ticket_id), subject)
+        subjects.update(fetched)
+    return subjects
+
+
+def raise_for_ticket_response(response: httpx.Response, integration: str):
+    """Map an upstream error to an HTTPException. A 404 is left to the caller."""
+    if response.status_code == 404 or not response.is_error:
+        return
+    if response.status_code == 429:
+        headers = {"Retry-After": response.headers["Retry-After"]} if "Retry-After" in response.headers else None
+        raise HTTPException(status_code=503, detail=f"{integration} is rate limiting requests", headers=headers)
+    raise HTTPException(status_code=502, detail=f"failed to fetch ticket from {integration}")
+
+
+async def get_ticket(http: httpx.AsyncClient, source, ticket_id: int):
+    """Fetch a ticket's subject, description and updated_at, cached briefly by source and ticket id."""
+    key = (str(source.id), ticket_id)
+    ticket = ticket_cache.get(key)
+    if ticket is not None:
+        return ticket
+    extra = json.loads(source.extra)
+    if source.name == "zendesk_integration":
+        header = {'Authorization': f"Bearer {extra['access_token']}"}
+        response = await http.get(f"https://{extra['subdomain']}/api/v2/tickets/{ticket_id}.json", headers=header)
+        raise_for_ticket_response(response, "zendesk")
+        if response.status_code == 404:
+            return None
+        data = response.json()["ticket"]
+        ticket = {
+            "subject": data["subject"] or "",
+            "description": data["description"] or "",
+            "updated_at": data["updated_at"],
+        }
+    else:
+        access_token = await get_hubspot_access_token(http, source)
+        header = {'Authorization': f"Bearer {access_token}"}
+        response = await http.get(
+            f"https://api.hubapi.com/crm/v3/objects/tickets/{ticket_id}?properties=subject,content,hs_lastmodifieddate",
+            headers=header
+        )
+        raise_for_ticket_response(response, "hubspot")
+        if response.status_code == 404:
+            return None
+        properties = response.json()["properties"]
+        ticket = {
+            "subject": properties.get("subject") or "",
+            "description": properties.get("content") or "",
+            "updated_at": properties.get("hs_lastmodifieddate"),
+        }
+    ticket_cache.set(key, ticket)
+    ticket_subject_cache.set(key, ticket["subject"])
+    return ticket
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""Per-request stage timings, reported as Server-Timing headers and histograms.
+
+Code marks a stage with ``with stage("encode"): ...``. While SERVER_TIMING is
+enabled, ServerTimingMiddleware collects every stage a request runs and
+returns the durations in a Server-Timing header. It also adds them to
+process-wide histograms that render_metrics exposes in Prometheus text
+format. When SERVER_TIMING is disabled the middleware is not installed and
+stage() returns at once.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+TIMING_ENABLED = os.getenv("SERVER_TIMING", "").lower() in ("1", "true", "yes")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_stages: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("stages", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+_histograms: Dict[Tuple[str, str], Histogram] = {}
+_lock = threading.Lock()
+
+
+@contextmanager
+def stage(name: str):
+    """Time the enclosed block as one stage of the current request."""
+    stages = _stages.get() if TIMING_ENABLED else None
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.append((name, time.perf_counter() - start))
+
+
+def get_totals(stages: List[Tuple[str, float]]) -> Dict[str, float]:
+    """Sum the durations of stages that ran more than once in a request."""
+    totals: Dict[str, float] = {}
+    for name, duration in stages:
+        totals[name] = totals.get(name, 0.0) + duration
+    return totals
+
+
+def observe(route: str, totals: Dict[str, float]):
+    with _lock:
+        for name, duration in totals.items():
+            histogram = _histograms.get((route, name))
+            if histogram is None:
+                histogram = _histograms[(route, name)] = Histogram()
+            histogram.observe(duration)
+
+
+def format_server_timing(totals: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in totals.items())
+
+
+def render_metrics() -> str:
+    lines = ["# TYPE request_stage_duration_seconds histogram"]
+    with _lock:
+        items = sorted(_histograms.items())
+        for (route, name), histogram in items:
+            labels = f'route="{route}",stage="{name}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'request_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"request_stage_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+            lines.append(f"request_stage_duration_seconds_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware that collects stage timings for each HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stages: List[Tuple[str, float]] = []
+        token = _stages.set(stages)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                stages.append(("total", time.perf_counter() - start))
+                totals = get_totals(stages)
+                observe(getattr(scope.get("route"), "path", "unmatched"), totals)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", format_server_timing(totals).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stages.reset(token)
@@ -1,18 +1,62 @@
+import hashlib
+import os
+import secrets
+from typing import Optional, Tuple
+
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import delete
+from sqlalchemy import delete, select
 
+from app.core.cache import TTLCache
 from app.models.user import APIKey, User
 
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", 30))
+
+# hashed key -> user id, so repeat requests with a key skip the database.
+# delete_api_key evicts revoked keys, so revocation is immediate in the process
+# that handled it. Other processes stop accepting the key within
+# API_KEY_CACHE_TTL seconds, the same kind of window principal_cache allows
+# for a deactivated user.
+api_key_cache = TTLCache(maxsize=10000, ttl=API_KEY_CACHE_TTL)
+
+
+def hash_api_key(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+async def get_api_key_user_id(db: AsyncSession, key: str) -> Optional[str]:
+    hashed_key = hash_api_key(key)
+    user_id = api_key_cache.get(hashed_key)
+    if user_id is None:
+        result = await db.execute(select(APIKey.user_id).where(APIKey.hashed_key == hashed_key))
+        user_id = result.scalar_one_or_none()
+        if user_id is None:
+            return None
+        api_key_cache.set(hashed_key, user_id)
+    return user_id
+
 
 async def delete_api_key(db: AsyncSession, user: User):
-    await db.execute(delete(APIKey).where(APIKey.user_id == str(user.id)))
+    """Delete the user's key and evict it from this process's cache.
+
+    generate_api_key calls this before issuing a new key, so replacing a key
+    evicts the old one too.
+    """
+    result = await db.execute(
+        delete(APIKey).where(APIKey.user_id == str(user.id)).returning(APIKey.hashed_key)
+    )
     await db.commit()
+    for hashed_key in result.scalars():
+        if hashed_key:
+            api_key_cache.pop(hashed_key)
     return
 
 
-async def create_api_key(db: AsyncSession, user: User):
-    api_key = APIKey(user_id=str(user.id))
+async def create_api_key(db: AsyncSession, user: User) -> Tuple[APIKey, str]:
+    """Create a key for the user. Only its hash is stored, so the plaintext
+    returned here is the only copy."""
+    key = secrets.token_urlsafe(32)
+    api_key = APIKey(user_id=str(user.id), hashed_key=hash_api_key(key))
     db.add(api_key)
     await db.commit()
     await db.refresh(api_key)
-    return api_key
+    return api_key, key
@@ -0,0 +1,182 @@
+import datetime
+from typing import List, Optional
+
+from sqlalchemy import desc, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.events import SearchDailyRollup, SearchDocRollup, SearchEvent, SearchZeroResultRollup
+from app.models.user import User
+
+
+def utc_today() -> datetime.date:
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+async def record_search(
+    db: AsyncSession,
+    user_id: str,
+    query_id: str,
+    query: str,
+    log_id: Optional[str],
+    results: list,
+):
+    """Append a search event and bump its rollups in the same transaction.
+
+    results are the search response's results, best first.
+    """
+    day = utc_today()
+    first = results[0] if results else None
+    db.add(SearchEvent(
+        user_id=user_id,
+        event_type="search",
+        query_id=query_id,
+        query=query,
+        log_id=log_id,
+        result_count=len(results),
+        first_result_score=first["score"] if first else None,
+        first_result_doc_name=first["doc_name"] if first else None,
+        first_result_doc_url=first["doc_url"] if first else None,
+    ))
+    stmt = insert(SearchDailyRollup).values(
+        user_id=user_id, day=day, query_count=1, zero_result_count=0 if first else 1, feedback_count=0
+    )
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "day"],
+        set_={
+            "query_count": SearchDailyRollup.query_count + 1,
+            "zero_result_count": SearchDailyRollup.zero_result_count + stmt.excluded.zero_result_count,
+        }
+    ))
+    if first:
+        stmt = insert(SearchDocRollup).values(
+            user_id=user_id,
+            day=day,
+            doc_url=first["doc_url"],
+            doc_name=first["doc_name"],
+            hit_count=1
+        )
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["user_id", "day", "doc_url"],
+            set_={"hit_count": SearchDocRollup.hit_count + 1, "doc_name": stmt.excluded.doc_name}
+        ))
+    else:
+        stmt = insert(SearchZeroResultRollup).values(user_id=user_id, day=day, query=query, count=1)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["user_id", "day", "query"],
+            set_={"count": SearchZeroResultRollup.count + 1}
+        ))
+    await db.commit()
+
+
+async def record_feedback(
+    db: AsyncSession,
+    user_id: str,
+    query_id: str,
+    event_type: str,
+    message: str,
+):
+    db.add(SearchEvent(
+        user_id=user_id,
+        event_type=event_type,
+        query_id=query_id,
+        message=message,
+    ))
+    stmt = insert(SearchDailyRollup).values(
+        user_id=user_id, day=utc_today(), query_count=0, zero_result_count=0, feedback_count=1
+    )
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "day"],
+        set_={"feedback_count": SearchDailyRollup.feedback_count + 1}
+    ))
+    await db.commit()
+
+
+async def get_team_user_ids(
+    db: AsyncSession,
+    owners: List[str],
+    emails: List[str],
+):
+    """Ids of the users who own, or are shared on, a set of sources."""
+    stmt = select(User.id).where(or_(User.id.in_(owners), User.email.in_(emails)))
+    result = await db.execute(stmt)
+    return [str(user_id) for user_id in result.scalars().all()]
+
+
+async def get_search_events(
+    db: AsyncSession,
+    user_ids: List[str],
+    start: datetime.datetime,
+):
+    stmt = select(
+        SearchEvent.created,
+        SearchEvent.query,
+        SearchEvent.user_id,
+        SearchEvent.log_id,
+        SearchEvent.first_result_doc_name,
+        SearchEvent.first_result_doc_url,
+    ).where(
+        SearchEvent.event_type == "search",
+        SearchEvent.user_id.in_(user_ids),
+        SearchEvent.created >= start
+    ).order_by(SearchEvent.created)
+    result = await db.execute(stmt)
+    return result.all()
+
+
+async def get_first_search_time(db: AsyncSession) -> Optional[datetime.datetime]:
+    """When search events started being stored locally. Earlier ones are only in gantry."""
+    result = await db.execute(select(func.min(SearchEvent.created)).where(SearchEvent.event_type == "search"))
+    return result.scalar_one_or_none()
+
+
+async def get_daily_rollups(
+    db: AsyncSession,
+    user_ids: List[str],
+    start: datetime.date,
+):
+    stmt = select(
+        SearchDailyRollup.day,
+        func.sum(SearchDailyRollup.query_count).label("query_count"),
+        func.sum(SearchDailyRollup.zero_result_count).label("zero_result_count"),
+        func.sum(SearchDailyRollup.feedback_count).label("feedback_count"),
+    ).where(
+        SearchDailyRollup.user_id.in_(user_ids),
+        SearchDailyRollup.day >= start
+    ).group_by(SearchDailyRollup.day).order_by(SearchDailyRollup.day)
+    result = await db.execute(stmt)
+    return result.all()
+
+
+async def get_top_docs(
+    db: AsyncSession,
+    user_ids: List[str],
+    start: datetime.date,
+    limit: int,
+):
+    hit_count = func.sum(SearchDocRollup.hit_count).label("hit_count")
+    stmt = select(
+        SearchDocRollup.doc_url,
+        func.max(SearchDocRollup.doc_name).label("doc_name"),
+        hit_count,
+    ).where(
+        SearchDocRollup.user_id.in_(user_ids),
+        SearchDocRollup.day >= start
+    ).group_by(SearchDocRollup.doc_url).order_by(desc(hit_count)).limit(limit)
+    result = await db.execute(stmt)
+    return result.all()
+
+
+async def get_zero_result_queries(
+    db: AsyncSession,
+    user_ids: List[str],
+    start: datetime.date,
+    limit: int,
+):
+    count = func.sum(SearchZeroResultRollup.count).label("count")
+    stmt = select(SearchZeroResultRollup.query, count).where(
+        SearchZeroResultRollup.user_id.in_(user_ids),
+        SearchZeroResultRollup.day >= start
+    ).group_by(SearchZeroResultRollup.query).order_by(desc(count)).limit(limit)
+    result = await db.execute(stmt)
+    return result.all()
\ No newline at end of file
@@ -1,5 +1,7 @@
+import json
 from typing import Any, Dict, List
-from sqlalchemy import select, update, or_
+from sqlalchemy import cast, select, text, update, or_
+from sqlalchemy.dialects.postgresql import JSONB
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -36,6 +38,27 @@ async def get_source(
     return result.scalars().first()
 
 
+async def get_source_by_id(
+    db: AsyncSession,
+    id: str,
+):
+    stmt = select(Source).where(Source.id == id)
+    result = await db.execute(stmt)
+    return result.scalars().first()
+
+
+async def get_hubspot_source_by_portal_id(
+    db: AsyncSession,
+    portal_id: str,
+):
+    stmt = select(Source).where(
+        Source.name == "hubspot_integration",
+        cast(Source.extra, JSONB)["portal_id"].astext == str(portal_id)
+    )
+    result = await db.execute(stmt)
+    return result.scalars().first()
+
+
 async def get_sources(
     db: AsyncSession,
     user_id: str,
@@ -59,4 +82,44 @@ async def update_source(
     result = await db.execute(stmt)
     await db.commit()
     return result.fetchone()
-    
\ No newline at end of file
+    
+
+async def add_source_webhook_doc_types(
+    db: AsyncSession,
+    id: str,
+    doc_types: List[str],
+):
+    """Add doc_types to extra["webhook_doc_types"] in place, leaving the rest of extra as it is."""
+    stmt = text("""
+        update source set extra = cast(jsonb_set(
+            coalesce(cast(extra as jsonb), '{}'),
+            '{webhook_doc_types}',
+            (
+                select jsonb_agg(doc_type order by doc_type) from (
+                    select jsonb_array_elements_text(coalesce(cast(extra as jsonb) -> 'webhook_doc_types', '[]'))
+                    union
+                    select unnest(cast(:doc_types as text[]))
+                ) as doc_types(doc_type)
+            )
+        ) as text)
+        where id = cast(:id as uuid)
+    """)
+    await db.execute(stmt, {"doc_types": list(doc_types), "id": str(id)})
+    await db.commit()
+
+
+async def set_source_extra_value(
+    db: AsyncSession,
+    id: str,
+    key: str,
+    value: Any,
+):
+    """Set one key of extra in place, leaving the rest of extra as it is."""
+    stmt = text("""
+        update source set extra = cast(jsonb_set(
+            coalesce(cast(extra as jsonb), '{}'), cast(:path as text[]), cast(:value as jsonb)
+        ) as text)
+        where id = cast(:id as uuid)
+    """)
+    await db.execute(stmt, {"path": [key], "value": json.dumps(value), "id": str(id)})
+    await db.commit()
@@ -0,0 +1,34 @@
+from typing import Any, Dict, List
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.metrics import TicketMetric
+
+
+async def get_ticket_metrics(
+    db: AsyncSession,
+    source_id: str,
+    ticket_ids: List[int],
+):
+    stmt = select(TicketMetric).where(
+        TicketMetric.source_id == source_id,
+        TicketMetric.ticket_id.in_(ticket_ids)
+    )
+    result = await db.execute(stmt)
+    return {metric.ticket_id: metric for metric in result.scalars().all()}
+
+
+async def store_ticket_metrics(
+    db: AsyncSession,
+    source_id: str,
+    metrics: List[Dict[str, Any]],
+):
+    if not metrics:
+        return
+    stmt = insert(TicketMetric).values([
+        {"source_id": source_id, **metric} for metric in metrics
+    ]).on_conflict_do_nothing()
+    await db.execute(stmt)
+    await db.commit()
\ No newline at end of file
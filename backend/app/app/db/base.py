@@ -3,4 +3,7 @@
 from app.db.base_class import Base  # noqa
 from app.models.user import OAuthAccount, User  # noqa
 from app.models.sources import Source  # noqa
-from app.models.documents import Document  # noqa
\ No newline at end of file
+from app.models.documents import ChunkFingerprint, Document, PendingDocument, WorkerCompletion  # noqa
+from app.models.metrics import TicketMetric  # noqa
+
+from app.models.events import SearchDailyRollup, SearchDocRollup, SearchEvent, SearchZeroResultRollup  # noqa
\ No newline at end of file
@@ -2,9 +2,19 @@ from fastapi import FastAPI
 from mangum import Mangum
 
 from app.api.api_v1.api import api_router
+from app.core.http import close_client
+from app.core.timing import TIMING_ENABLED, ServerTimingMiddleware
 
 api = FastAPI()
+if TIMING_ENABLED:
+    api.add_middleware(ServerTimingMiddleware)
 
 api.include_router(api_router, prefix="/v0")
 
+
+@api.on_event("shutdown")
+async def shutdown():
+    await close_client()
+
+
 handler = Mangum(api, lifespan="off")
\ No newline at end of file
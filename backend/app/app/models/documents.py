@@ -1,6 +1,7 @@
 import uuid
 
-from sqlalchemy import Boolean, Column, String, ForeignKey, DateTime
+from sqlalchemy import BigInteger, Boolean, Column, Integer, String, ForeignKey, DateTime, Index, PrimaryKeyConstraint
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID
 
@@ -8,6 +9,11 @@ from app.db.base_class import Base
 
 class Document(Base):
     __tablename__ = "document"
+    __table_args__ = (
+        Index("ix_document_owner_type_doc_id", "owner", "type", "doc_id"),
+        Index("ix_document_source_id", "source_id"),
+        Index("ix_document_chunk_ids", "chunk_ids", postgresql_using="gin"),
+    )
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     owner = Column(UUID, ForeignKey("user.id"), nullable=False)
     name = Column(String, nullable=False)
@@ -19,4 +25,60 @@ class Document(Base):
         DateTime(timezone=True), server_default=func.now(), nullable=False
     )
     updated = Column(DateTime(timezone=True), onupdate=func.now())
-    extra = Column(String)
\ No newline at end of file
+    extra = Column(String)
+    # Not a foreign key: rows outlive a removed source until compaction has
+    # deleted their vectors.
+    source_id = Column(UUID)
+    # Vector ids of the chunks last indexed for this document.
+    chunk_ids = Column(ARRAY(String))
+
+
+class PendingDocument(Base):
+    __tablename__ = "pending_document"
+    __table_args__ = (
+        PrimaryKeyConstraint("source_id", "type", "doc_id"),
+        # The scheduler counts live leases for its budget and requeues expired ones.
+        Index("ix_pending_document_lease_expires", "lease_expires"),
+    )
+    source_id = Column(UUID, ForeignKey("source.id", ondelete="CASCADE"), nullable=False)
+    type = Column(String, nullable=False)
+    doc_id = Column(String, nullable=False)
+    doc_last_updated = Column(DateTime(timezone=True))
+    lease_expires = Column(DateTime(timezone=True), nullable=False)
+    # The queue message's document, so the scheduler can send it again by itself.
+    descriptor = Column(JSONB)
+    # Set by the worker when a newer change arrived while it was indexing this one.
+    needs_reindex = Column(Boolean, server_default="false", nullable=False)
+    created = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+
+class ChunkFingerprint(Base):
+    """MinHash signature of an indexed chunk, for finding near-duplicates within a source.
+
+    canonical_id is the vector that holds the chunk's embedding: its own
+    vector_id, or that of an earlier near-duplicate chunk.
+    """
+    __tablename__ = "chunk_fingerprint"
+    __table_args__ = (
+        PrimaryKeyConstraint("source_id", "vector_id"),
+        Index("ix_chunk_fingerprint_source_canonical", "source_id", "canonical_id"),
+        Index("ix_chunk_fingerprint_bands", "bands", postgresql_using="gin"),
+    )
+    source_id = Column(UUID, ForeignKey("source.id", ondelete="CASCADE"), nullable=False)
+    vector_id = Column(String, nullable=False)
+    canonical_id = Column(String, nullable=False)
+    doc_url = Column(String)
+    signature = Column(ARRAY(BigInteger), nullable=False)
+    bands = Column(ARRAY(String), nullable=False)
+    created = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+
+class WorkerCompletion(Base):
+    """Documents the worker finished in each minute, for the scheduler's throughput estimate."""
+    __tablename__ = "worker_completion"
+    minute = Column(DateTime(timezone=True), primary_key=True)
+    count = Column(Integer, nullable=False)
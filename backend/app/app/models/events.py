@@ -0,0 +1,54 @@
+import uuid
+
+from sqlalchemy import Column, Date, DateTime, Float, ForeignKey, Integer, PrimaryKeyConstraint, String
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.sql import func
+
+from app.db.base_class import Base
+
+
+class SearchEvent(Base):
+    __tablename__ = "search_event"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID, ForeignKey("user.id"), nullable=False)
+    event_type = Column(String, nullable=False)
+    query_id = Column(String, nullable=False)
+    query = Column(String)
+    log_id = Column(String)
+    result_count = Column(Integer)
+    first_result_score = Column(Float)
+    first_result_doc_name = Column(String)
+    first_result_doc_url = Column(String)
+    message = Column(String)
+    created = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False, index=True
+    )
+
+
+class SearchDailyRollup(Base):
+    __tablename__ = "search_daily_rollup"
+    __table_args__ = (PrimaryKeyConstraint("user_id", "day"),)
+    user_id = Column(UUID, ForeignKey("user.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    query_count = Column(Integer, nullable=False, default=0)
+    zero_result_count = Column(Integer, nullable=False, default=0)
+    feedback_count = Column(Integer, nullable=False, default=0)
+
+
+class SearchDocRollup(Base):
+    __tablename__ = "search_doc_rollup"
+    __table_args__ = (PrimaryKeyConstraint("user_id", "day", "doc_url"),)
+    user_id = Column(UUID, ForeignKey("user.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    doc_url = Column(String, nullable=False)
+    doc_name = Column(String)
+    hit_count = Column(Integer, nullable=False, default=0)
+
+
+class SearchZeroResultRollup(Base):
+    __tablename__ = "search_zero_result_rollup"
+    __table_args__ = (PrimaryKeyConstraint("user_id", "day", "query"),)
+    user_id = Column(UUID, ForeignKey("user.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    query = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
\ No newline at end of file
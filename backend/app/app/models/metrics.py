@@ -0,0 +1,18 @@
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Integer, PrimaryKeyConstraint
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.sql import func
+
+from app.db.base_class import Base
+
+
+class TicketMetric(Base):
+    __tablename__ = "ticket_metric"
+    __table_args__ = (PrimaryKeyConstraint("source_id", "ticket_id"),)
+    source_id = Column(UUID, ForeignKey("source.id", ondelete="CASCADE"), nullable=False)
+    ticket_id = Column(BigInteger, nullable=False)
+    first_resolution_time_in_minutes = Column(Integer)
+    full_resolution_time_in_minutes = Column(Integer)
+    solved_at = Column(DateTime(timezone=True))
+    created = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
\ No newline at end of file
@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import Column, String, ForeignKey, DateTime
+from sqlalchemy import Column, String, ForeignKey, DateTime, Index
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID
@@ -9,6 +9,10 @@ from app.db.base_class import Base
 
 class Source(Base):
     __tablename__ = "source"
+    __table_args__ = (
+        Index("ix_source_owner_name", "owner", "name"),
+        Index("ix_source_shared_with", "shared_with", postgresql_using="gin"),
+    )
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     owner = Column(UUID, ForeignKey("user.id"), nullable=False)
     name = Column(String, nullable=False)
@@ -5,7 +5,7 @@ from fastapi_users.db import (
     SQLAlchemyBaseOAuthAccountTableUUID,
     SQLAlchemyBaseUserTableUUID,
 )
-from sqlalchemy import Column, DateTime, ForeignKey
+from sqlalchemy import Column, DateTime, ForeignKey, String
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -22,11 +22,12 @@ class APIKey(Base):
     __tablename__ = "api_key"
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID, ForeignKey("user.id"), unique=True, nullable=False)
+    hashed_key = Column(String, unique=True, index=True)
     user = relationship("User", back_populates="api_key", uselist=False, lazy="joined")
     created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
 
 class User(SQLAlchemyBaseUserTableUUID, Base):
     oauth_accounts: List[OAuthAccount] = relationship("OAuthAccount", lazy="joined")
-    api_key: APIKey = relationship("APIKey", back_populates="user", uselist=False, lazy="joined")
-    sources: List[Source] = relationship("Source", lazy="joined")
\ No newline at end of file
+    api_key: APIKey = relationship("APIKey", back_populates="user", uselist=False)
+    sources: List[Source] = relationship("Source")
\ No newline at end of file
@@ -9,6 +9,7 @@ class SearchResult(BaseModel):
     doc_url: str
     score: float
     text: str
+    doc_refs: List[str] = []
 
 
 class SearchResponse(BaseModel):
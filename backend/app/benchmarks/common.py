@@ -0,0 +1,62 @@
+import datetime
+import json
+import math
+import os
+import subprocess
+from typing import Any, Dict, List
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of values, which must already be sorted."""
+    if not values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        "mean_ms": round(sum(values) / len(values), 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 2),
+        "p95_ms": round(percentile(values, 95), 2),
+        "p99_ms": round(percentile(values, 99), 2),
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(path: str, benchmark: str, config: Dict[str, Any], results: List[Dict[str, Any]]):
+    """Write results as sorted, indented JSON so two runs diff cleanly."""
+    report = {
+        "benchmark": benchmark,
+        "commit": get_commit(),
+        "created": datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+        "config": config,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare_results(baseline_path: str, results: List[Dict[str, Any]], key: str, metrics: List[str]):
+    """Print each metric next to the baseline run with the same key value."""
+    with open(baseline_path) as f:
+        baseline = {result[key]: result for result in json.load(f)["results"]}
+    for result in results:
+        previous = baseline.get(result[key])
+        if previous is None:
+            continue
+        changes = []
+        for metric in metrics:
+            before, after = previous[metric], result[metric]
+            change = (after - before) / before * 100 if before else 0.0
+            changes.append(f"{metric} {before} -> {after} ({change:+.1f}%)")
+        print(f"{key}={result[key]}: " + ", ".join(changes))
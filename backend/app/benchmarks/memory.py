@@ -0,0 +1,124 @@
+"""Measure API memory per worker with the encoder preloaded or loaded per worker.
+
+For each MODEL_LOADING mode and worker count, starts gunicorn with
+gunicorn_conf.py, waits until /v0/health-check answers and worker memory has
+settled, then reads /proc/<pid>/smaps_rollup for the master and every worker.
+RSS counts shared pages in full for every process. PSS splits them between
+the processes that share them, so the PSS total is the real footprint. With
+preloading, the PSS total should stay roughly flat as workers are added. Linux
+only.
+
+    python -m benchmarks.memory --workers 1 2 4 8
+    python -m benchmarks.memory --compare benchmarks/results/memory.json
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.common import compare_results, save_results
+
+MODES = ["preload", "worker", "lazy"]
+
+
+def read_memory(pid: int) -> Dict[str, int]:
+    """RSS, PSS and USS of a process in KiB."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {
+        "rss_kb": fields.get("Rss", 0),
+        "pss_kb": fields.get("Pss", 0),
+        "uss_kb": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def get_children(pid: int) -> List[int]:
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children.extend(int(child) for child in f.read().split())
+    return children
+
+
+def wait_until_settled(port: int, master: int, workers: int, timeout: float):
+    """Wait for every worker to start and for total RSS to stop changing."""
+    deadline = time.monotonic() + timeout
+    previous = None
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        pids = get_children(master)
+        if len(pids) < workers:
+            continue
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/v0/health-check").status_code != 200:
+                continue
+        except httpx.HTTPError:
+            continue
+        total = sum(read_memory(pid)["rss_kb"] for pid in pids)
+        if previous is not None and abs(total - previous) < 1024:
+            return pids
+        previous = total
+    raise TimeoutError(f"{workers} workers did not settle within {timeout}s")
+
+
+def measure(mode: str, workers: int, port: int, timeout: float) -> Dict:
+    env = {**os.environ, "MODEL_LOADING": mode, "WEB_CONCURRENCY": str(workers), "BIND": f"127.0.0.1:{port}"}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn_conf.py", "app.main:api"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        pids = wait_until_settled(port, process.pid, workers, timeout)
+        master = read_memory(process.pid)
+        per_worker = [read_memory(pid) for pid in pids]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+    return {
+        "key": f"{mode}/{workers}",
+        "mode": mode,
+        "workers": workers,
+        "master_rss_mb": round(master["rss_kb"] / 1024, 1),
+        "worker_rss_mb": round(sum(w["rss_kb"] for w in per_worker) / len(per_worker) / 1024, 1),
+        "worker_uss_mb": round(sum(w["uss_kb"] for w in per_worker) / len(per_worker) / 1024, 1),
+        "total_pss_mb": round((master["pss_kb"] + sum(w["pss_kb"] for w in per_worker)) / 1024, 1),
+    }
+
+
+def main(args):
+    results = []
+    for mode in args.modes:
+        for workers in args.workers:
+            result = measure(mode, workers, args.port, args.timeout)
+            print(
+                f"{mode:8} workers={workers:<3} master_rss={result['master_rss_mb']}MB "
+                f"worker_rss={result['worker_rss_mb']}MB worker_uss={result['worker_uss_mb']}MB "
+                f"total_pss={result['total_pss_mb']}MB"
+            )
+            results.append(result)
+    if args.compare:
+        compare_results(args.compare, results, "key", ["worker_uss_mb", "total_pss_mb"])
+    config = {key: value for key, value in vars(args).items() if key not in ["output", "compare", "port"]}
+    save_results(args.output, "memory", config, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--modes", nargs="+", default=["preload", "worker"], choices=MODES)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", default="benchmarks/results/memory.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    main(parser.parse_args())
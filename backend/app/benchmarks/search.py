@@ -0,0 +1,235 @@
+"""Load-test /v0/search in process against local stand-ins.
+
+The app is served by uvicorn on a background thread, with a seeded Postgres
+(SQLALCHEMY_DATABASE_URL, migrated to head) and real JWT auth. Pinecone is
+replaced by an in-memory index that scores a random corpus and sleeps for a
+configurable latency. OpenAI completions and gantry logging are stubbed. The
+sentence encoder is real unless --fake-encoder is given; stand-ins are set on
+app.core.clients before the first request, so the real clients are never
+created.
+
+Each concurrency level reports p50/p95/p99 latency and throughput. Results are
+written as JSON that diffs cleanly between runs, and --compare prints the
+change against an earlier file:
+
+    python -m benchmarks.search --concurrency 1 8 32 --requests 500
+    python -m benchmarks.search --compare benchmarks/results/search.json
+
+The seeded user, sources and search events are deleted when the run ends.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+import uuid
+
+import httpx
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+import uvicorn
+
+from app.api.deps import get_jwt_strategy
+from app.core import clients
+from app.db.session import DATABASE_URL
+from app.main import api
+from benchmarks.common import compare_results, save_results, summarize_latencies
+
+QUERIES = [
+    "How do I reset my password?",
+    "Can I export my data to CSV?",
+    "Why was my card declined?",
+    "How do I add a teammate to my account?",
+    "Where can I change my billing address?",
+    "Does the API support pagination?",
+    "How long do refunds take?",
+    "My integration stopped syncing",
+]
+
+
+class FakeIndex:
+    """Brute-force cosine search over a random corpus, standing in for pinecone.Index."""
+
+    def __init__(self, corpus_size: int, dimension: int, latency_ms: float, source_ids: List[str]):
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((corpus_size, dimension)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.source_ids = np.array([source_ids[i % len(source_ids)] for i in range(corpus_size)])
+        self.latency = latency_ms / 1000
+
+    def query(self, queries, top_k, filter, include_metadata, include_values, namespace):
+        time.sleep(self.latency)
+        query = np.asarray(queries[0], dtype=np.float32).reshape(-1)
+        scores = self.vectors @ (query / np.linalg.norm(query))
+        scores[~np.isin(self.source_ids, filter["source_id"]["$in"])] = -np.inf
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        matches = [
+            {
+                "id": str(i),
+                "score": float(scores[i]),
+                "metadata": {
+                    "doc_name": f"Document {i}",
+                    "doc_last_updated": "2022-01-01T00:00:00Z",
+                    "doc_url": f"https://example.com/docs/{i}",
+                    "text": f"Body of document {i}. " * 20,
+                },
+            }
+            for i in top if np.isfinite(scores[i])
+        ]
+        return {"results": [{"matches": matches}]}
+
+
+class FakeEncoder:
+    def __init__(self, dimension: int):
+        self.dimension = dimension
+
+    def encode(self, sentences):
+        rng = np.random.default_rng(abs(hash(tuple(sentences))) % 2**32)
+        return rng.standard_normal((len(sentences), self.dimension)).astype(np.float32)
+
+
+def install_stand_ins(args, source_ids: List[str]):
+    if args.fake_encoder:
+        clients._search_model = FakeEncoder(args.dimension)
+        dimension = args.dimension
+    else:
+        dimension = clients.get_search_model().get_sentence_embedding_dimension()
+    clients._index = FakeIndex(args.corpus_size, dimension, args.index_latency_ms, source_ids)
+
+    def create_completion(**kwargs):
+        time.sleep(args.completion_latency_ms / 1000)
+        return SimpleNamespace(choices=[{"text": " You can do that from the settings page."}])
+
+    clients._openai = SimpleNamespace(Completion=SimpleNamespace(create=create_completion))
+    clients._gantry = SimpleNamespace(log_record=lambda **kwargs: None)
+
+
+async def seed(engine, source_count: int):
+    user_id = str(uuid.uuid4())
+    source_ids = [str(uuid.uuid4()) for _ in range(source_count)]
+    async with engine.begin() as connection:
+        await connection.execute(
+            text(
+                "insert into \"user\" (id, email, hashed_password, is_active, is_superuser, is_verified) "
+                "values (:id, :email, '', true, false, true)"
+            ),
+            {"id": user_id, "email": f"bench-{user_id}@example.com"},
+        )
+        await connection.execute(
+            text("insert into source (id, owner, name, shared_with, extra) values (:id, :owner, :name, '{}', '{}')"),
+            [{"id": id, "owner": user_id, "name": f"bench_source_{i}"} for i, id in enumerate(source_ids)],
+        )
+    return user_id, source_ids
+
+
+async def cleanup(engine, user_id: str):
+    async with engine.begin() as connection:
+        for table in [
+            "search_event",
+            "search_daily_rollup",
+            "search_doc_rollup",
+            "search_zero_result_rollup",
+            "source",
+        ]:
+            column = "owner" if table == "source" else "user_id"
+            await connection.execute(text(f"delete from {table} where {column} = :user_id"), {"user_id": user_id})
+        await connection.execute(text("delete from \"user\" where id = :user_id"), {"user_id": user_id})
+
+
+class Server(uvicorn.Server):
+    def install_signal_handlers(self):
+        pass
+
+
+def start_server(port: int) -> Tuple[Server, threading.Thread]:
+    server = Server(uvicorn.Config(api, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def run_level(client: httpx.AsyncClient, concurrency: int, requests: int, count: int) -> Dict:
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in remaining:
+            start = time.perf_counter()
+            response = await client.get("/v0/search", params={"query": QUERIES[i % len(QUERIES)], "count": count})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 2),
+        **summarize_latencies(latencies),
+    }
+
+
+async def main(args):
+    engine = create_async_engine(DATABASE_URL)
+    user_id, source_ids = await seed(engine, args.sources)
+    try:
+        install_stand_ins(args, source_ids)
+        token = await get_jwt_strategy().write_token(SimpleNamespace(id=user_id))
+        server, thread = start_server(args.port)
+        results = []
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.port}",
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=60,
+            limits=httpx.Limits(max_connections=max(args.concurrency)),
+        ) as client:
+            await run_level(client, 1, args.warmup, args.count)
+            for concurrency in args.concurrency:
+                result = await run_level(client, concurrency, args.requests, args.count)
+                print(
+                    f"concurrency={concurrency} rps={result['throughput_rps']} p50={result['p50_ms']}ms "
+                    f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms errors={result['errors']}"
+                )
+                results.append(result)
+        # Let in-flight background tasks finish writing events before cleanup.
+        server.should_exit = True
+        thread.join()
+    finally:
+        await cleanup(engine, user_id)
+        await engine.dispose()
+
+    config = {
+        key: value for key, value in vars(args).items() if key not in ["output", "compare", "port"]
+    }
+    if args.compare:
+        compare_results(args.compare, results, "concurrency", ["throughput_rps", "p50_ms", "p95_ms", "p99_ms"])
+    save_results(args.output, "search", config, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--count", type=int, default=10, help="results per search")
+    parser.add_argument("--sources", type=int, default=3)
+    parser.add_argument("--corpus-size", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=768, help="embedding size with --fake-encoder")
+    parser.add_argument("--index-latency-ms", type=float, default=30)
+    parser.add_argument("--completion-latency-ms", type=float, default=400)
+    parser.add_argument("--fake-encoder", action="store_true")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default="benchmarks/results/search.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,54 @@
+"""Gunicorn settings for serving the API outside Lambda with several workers.
+
+    gunicorn -c gunicorn_conf.py app.main:api
+
+MODEL_LOADING controls where the sentence encoder is loaded:
+
+- ``preload`` (default): once in the master before forking. Workers share the
+  weights copy-on-write, so model memory stays flat as workers are added.
+- ``worker``: separately in every worker as it starts.
+- ``lazy``: on the first search in each worker, as under Lambda.
+
+Only the encoder is loaded on purpose. Pinecone and the HTTP client are
+created on first use, so each worker makes its own. The database engine is
+created when the master imports the app, so post_fork drops any connections
+it inherited and each worker opens its own.
+
+docker-compose.yml runs this configuration as the api-gunicorn service.
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+bind = os.getenv("BIND", "0.0.0.0:3000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("TIMEOUT", 120))
+
+MODEL_LOADING = os.getenv("MODEL_LOADING", "preload")
+# Each worker gets its share of the cores so torch's intra-op threads do not oversubscribe them.
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", max(1, multiprocessing.cpu_count() // workers)))
+
+
+def on_starting(server):
+    if MODEL_LOADING != "preload":
+        return
+    from app.core.clients import get_search_model
+    get_search_model()
+    # Keep the cyclic collector from writing to the preloaded objects' pages in
+    # the workers, which would turn shared pages into private copies.
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app.db.session import engine
+    # close=False leaves the master's connections, if any, for the master to close.
+    engine.sync_engine.dispose(close=False)
+    if MODEL_LOADING == "worker":
+        from app.core.clients import get_search_model
+        get_search_model()
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(TORCH_THREADS)
@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+import heapq
 import itertools
 import json
 import logging
@@ -6,7 +8,7 @@ import os
 import uuid
 
 import boto3
-import bs4
+from lxml import etree
 import pytz
 import requests
 from sqlalchemy import create_engine, text
@@ -15,7 +17,46 @@ from sqlalchemy import create_engine, text
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-UPSERT_LIMIT=1000
+# Upper bound on documents enqueued per run; the actual budget is sized from
+# the pending ledger and recent worker throughput by get_upsert_budget.
+UPSERT_LIMIT = int(os.getenv("UPSERT_LIMIT", 1000))
+MIN_UPSERT_LIMIT = int(os.getenv("MIN_UPSERT_LIMIT", 50))
+THROUGHPUT_WINDOW_MINUTES = int(os.getenv("THROUGHPUT_WINDOW_MINUTES", 15))
+TARGET_BACKLOG_WINDOWS = float(os.getenv("TARGET_BACKLOG_WINDOWS", 2))
+DOCUMENTS_PER_MESSAGE = int(os.getenv("DOCUMENTS_PER_MESSAGE", 10))
+# SendMessageBatch caps the whole batch at 256 KiB, so each of its 10 entries
+# gets a tenth of that.
+MAX_MESSAGE_BYTES = 256 * 1024 // 10
+SEND_CONCURRENCY = int(os.getenv("SQS_SEND_CONCURRENCY", 8))
+PENDING_LEASE_MINUTES = int(os.getenv("PENDING_LEASE_MINUTES", 60))
+# Doc types that receive webhooks are only polled this often, to reconcile missed events.
+RECONCILE_INTERVAL_HOURS = int(os.getenv("RECONCILE_INTERVAL_HOURS", 24))
+# A source with no changes observed is still polled at least this often.
+MAX_POLL_INTERVAL_HOURS = float(os.getenv("MAX_POLL_INTERVAL_HOURS", 24))
+DEFAULT_CHANGE_RATE = 1.0
+SOURCE_PAGE_SIZE = 1000
+MAX_SOURCES_PER_RUN = int(os.getenv("MAX_SOURCES_PER_RUN", 500))
+# The only extra keys score_source reads.
+SIGNAL_KEYS = [
+    "change_rate",
+    "failures",
+    "last_failure",
+    "webhook_doc_types",
+    "reconciled",
+    "hc_next_page",
+    "has_more",
+    "after",
+    "sitemap_truncated",
+    "deferred_since",
+    "initial_index_completed",
+]
+SOURCE_DOC_TYPES = {
+    "zendesk_integration": ["zendesk_help_center_article", "zendesk_ticket"],
+    "hubspot_integration": ["hubspot_help_center_article", "hubspot_ticket"],
+}
+CHANGE_RATE_ALPHA = 0.3
+FAILURE_BACKOFF_MINUTES = 15
+MAX_FAILURE_BACKOFF_HOURS = 24
 
 
 def chunks(iterable, batch_size=10):
@@ -26,24 +67,197 @@ def chunks(iterable, batch_size=10):
         chunk = tuple(itertools.islice(it, batch_size))
 
 
-def get_sources(engine, source_id=None):
-    with engine.connect() as connection:
-        if source_id:
-            sources = connection.execute(
-                text(f"select * from source where id = '{source_id}'")
-            ).fetchall()
-        else:
-            sources = connection.execute(
-                text(f"select * from source order by updated asc")
+def iter_source_signals(engine, page_size=SOURCE_PAGE_SIZE):
+    """Stream id, name, updated and the scheduling keys of extra for every source.
+
+    Keyset-paginated on id, so only one page of small rows is held at a time.
+    Tokens and other large extra values never leave the database.
+    """
+    last_id = "00000000-0000-0000-0000-000000000000"
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text("""
+                    select id, name, updated, (
+                        select coalesce(jsonb_object_agg(key, value), '{}'::jsonb)
+                        from jsonb_each(coalesce(extra, '{}')::jsonb)
+                        where key = any(:keys)
+                    ) as signals
+                    from source
+                    where id > :last_id
+                    order by id
+                    limit :limit
+                """),
+                {"keys": SIGNAL_KEYS, "last_id": last_id, "limit": page_size}
             ).fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last_id = str(rows[-1].id)
+
+
+def get_sources(engine, source_ids):
+    with engine.connect() as connection:
+        sources = connection.execute(
+            text("select id, owner, name, updated, extra from source where id = any(cast(:ids as uuid[]))"),
+            {"ids": [str(source_id) for source_id in source_ids]}
+        ).fetchall()
     return sources
 
 
+def get_queued_documents(engine):
+    """Number of documents enqueued and not yet finished, from the live leases in the pending ledger."""
+    with engine.connect() as connection:
+        return connection.execute(text("select count(*) from pending_document where lease_expires > now()")).scalar()
+
+
+def get_worker_throughput(engine, window_minutes=THROUGHPUT_WINDOW_MINUTES):
+    """Number of documents the worker finished during the last window_minutes.
+
+    Counts from before the window are no longer needed and are deleted.
+    """
+    params = {"minutes": window_minutes}
+    with engine.begin() as connection:
+        connection.execute(
+            text("delete from worker_completion where minute < now() - make_interval(mins => :minutes)"), params
+        )
+        return connection.execute(
+            text("""
+                select coalesce(sum(count), 0) from worker_completion
+                where minute > now() - make_interval(mins => :minutes)
+            """),
+            params
+        ).scalar()
+
+
+def get_upsert_budget(engine):
+    """Size this run so at most TARGET_BACKLOG_WINDOWS of worker throughput is queued.
+
+    An idle worker starts from MIN_UPSERT_LIMIT and the budget roughly doubles
+    every window while the worker keeps up. A saturated worker gets a budget of 0.
+    """
+    queued_documents = get_queued_documents(engine)
+    throughput = get_worker_throughput(engine)
+    capacity = max(throughput * TARGET_BACKLOG_WINDOWS, MIN_UPSERT_LIMIT)
+    budget = int(min(capacity - queued_documents, UPSERT_LIMIT))
+    logger.info(f"{queued_documents} docs queued, worker throughput {throughput} docs, budget {budget}")
+    return max(budget, 0)
+
+
+def get_extra_changes(source, extra):
+    """The keys of extra that differ from the source row as read, and the keys removed from it."""
+    original = json.loads(source["extra"]) if source["extra"] else {}
+    changes = {key: value for key, value in extra.items() if key not in original or original[key] != value}
+    removed = sorted(original.keys() - extra.keys())
+    return changes, removed
+
+
+def merge_source_extra(connection, source, extra, updated=None):
+    """Write only what changed in extra, so keys set meanwhile by the API, like webhook_doc_types, survive."""
+    changes, removed = get_extra_changes(source, extra)
+    connection.execute(
+        text("""
+            update source SET
+            updated = coalesce(cast(:updated as timestamp with time zone), updated),
+            extra = cast((coalesce(cast(extra as jsonb), '{}') - cast(:removed as text[])) || cast(:changes as jsonb) as text)
+            where id = :id
+        """),
+        {"updated": updated, "changes": json.dumps(changes), "removed": removed, "id": str(source["id"])}
+    )
+
+
 def update_source(engine, source, extra):
-    extra_str = json.dumps(extra)
     with engine.connect() as connection:
         current = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        connection.execute(text(f"update source SET updated = '{current}'::timestamp with TIME ZONE, extra = '{extra_str}' where id = '{str(source['id'])}'"))
+        merge_source_extra(connection, source, extra, updated=current)
+
+
+def record_source_failure(engine, source):
+    """Count a failed sync in extra without touching updated, the last successful sync time."""
+    extra = json.loads(source["extra"]) if source["extra"] else {}
+    extra["failures"] = extra.get("failures", 0) + 1
+    extra["last_failure"] = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    with engine.connect() as connection:
+        merge_source_extra(connection, source, extra)
+
+
+def has_backlog(extra):
+    return bool(
+        extra.get("hc_next_page")
+        or extra.get("has_more")
+        or extra.get("after")
+        or extra.get("sitemap_truncated")
+        or extra.get("deferred_since")
+        or not extra.get("initial_index_completed")
+    )
+
+
+def score_source(source, extra, now):
+    """Estimate how many changes are waiting in a source. It is due once that reaches 1.
+
+    The estimate is the observed change rate times the hours since the last
+    successful sync. Staleness adds a term that reaches 1 after
+    MAX_POLL_INTERVAL_HOURS, and any pending backlog makes the source due
+    straight away. Consecutive failures back off exponentially. A source whose
+    doc types all receive webhooks is only reconciled every
+    RECONCILE_INTERVAL_HOURS. One with a polled doc type left, such as HubSpot
+    articles, keeps its normal schedule.
+    """
+    if not source.updated:
+        return float("inf")
+    hours_since_sync = (now - source.updated).total_seconds() / 3600
+    if set(extra.get("webhook_doc_types", [])).issuperset(SOURCE_DOC_TYPES.get(source.name, [None])):
+        return hours_since_reconcile(extra, now) / RECONCILE_INTERVAL_HOURS
+    failures = extra.get("failures", 0)
+    if failures:
+        backoff_hours = min(FAILURE_BACKOFF_MINUTES * 2 ** (failures - 1) / 60, MAX_FAILURE_BACKOFF_HOURS)
+        if now.timestamp() - extra.get("last_failure", 0) < backoff_hours * 3600:
+            return 0
+    score = extra.get("change_rate", DEFAULT_CHANGE_RATE) * hours_since_sync
+    score += hours_since_sync / MAX_POLL_INTERVAL_HOURS
+    if has_backlog(extra):
+        score += 1
+    return score
+
+
+def hours_since_reconcile(extra, now):
+    """Hours since webhook doc types were last polled. Never polled since they got webhooks counts as overdue."""
+    if not extra.get("reconciled"):
+        return float("inf")
+    return (now.timestamp() - extra["reconciled"]) / 3600
+
+
+def prioritize_sources(engine, now, max_sources=MAX_SOURCES_PER_RUN):
+    """Return (source, extra) pairs for the due sources, highest score first.
+
+    Scores are computed from the streamed signals. Only the top max_sources are
+    kept, so memory stays flat however many sources exist, and just those rows
+    are loaded in full.
+    """
+    total = 0
+    due = []
+    for row in iter_source_signals(engine):
+        total += 1
+        score = score_source(row, row.signals, now)
+        if score >= 1:
+            due.append((score, str(row.id)))
+            if len(due) > 2 * max_sources:
+                due = heapq.nlargest(max_sources, due)
+    due = heapq.nlargest(max_sources, due)
+    logger.info(f"{len(due)} of {total} sources are due")
+    ranks = {source_id: rank for rank, (_, source_id) in enumerate(due)}
+    sources = sorted(get_sources(engine, list(ranks)), key=lambda source: ranks[str(source.id)])
+    return [(source, json.loads(source["extra"]) if source["extra"] else {}) for source in sources]
+
+
+def update_change_rate(source, extra, found, now):
+    """Fold the number of changed documents found this run into an exponentially weighted rate per hour."""
+    if not source.updated:
+        return extra
+    hours = max((now - source.updated).total_seconds() / 3600, 1 / 60)
+    previous = extra.get("change_rate", DEFAULT_CHANGE_RATE)
+    extra["change_rate"] = CHANGE_RATE_ALPHA * (found / hours) + (1 - CHANGE_RATE_ALPHA) * previous
+    return extra
 
 
 def get_zendesk_credentials(source):
@@ -69,39 +283,78 @@ def get_hubspot_access_token(source):
     return access_token
 
 
-def get_zendesk_hc_articles(source):
+def iter_zendesk_hc_article_pages(url, header):
+    """Yield (articles, next_url, end_time) for every page starting at url.
+
+    Raises on an error response, so a rate-limited or failed page is never
+    mistaken for the end of the pass. The caller's checkpoint stays where it
+    was and the source backs off through record_source_failure.
+    """
+    while url:
+        response = requests.get(url, headers=header)
+        response.raise_for_status()
+        data = response.json()
+        articles = data.get("articles", [])
+        if data.get("meta", {}).get("has_more"):
+            next_url = data.get("links", {}).get("next")
+        else:
+            next_url = data.get("next_page")
+        if not articles:
+            next_url = None
+        yield articles, next_url, data.get("end_time")
+        url = next_url
+
+
+def get_zendesk_hc_articles(source, extra, limit=UPSERT_LIMIT):
     subdomain, access_token = get_zendesk_credentials(source)
     if not subdomain and not access_token:
         raise Exception("subdomain and access token need to be provided")
-    if not source.updated:
-        url = f"https://{subdomain}/api/v2/help_center/articles.json?sort_by=updated_at&sort_order=desc"
-    else:
-        start_time = source.updated.timestamp()
-        url = f"https://{subdomain}/api/v2/help_center/incremental/articles.json?start_time={start_time}"
+    extra = extra.copy()
+    url = extra.get("hc_next_page")
+    if not url:
+        start_time = extra.get("hc_start_time")
+        if start_time is None and source.updated:
+            start_time = int(source.updated.timestamp())
+        extra["hc_sync_started"] = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        if start_time is None:
+            url = f"https://{subdomain}/api/v2/help_center/articles.json?sort_by=updated_at&sort_order=desc&page[size]=100"
+        else:
+            url = f"https://{subdomain}/api/v2/help_center/incremental/articles.json?start_time={start_time}"
     bearer_token = f"Bearer {access_token}"
     header = {'Authorization': bearer_token}
-    articles = requests.get(url, headers=header).json().get("articles", [])
-    return [
-        {
-            "owner": str(source["owner"]),
-            "doc_type": "zendesk_help_center_article",
-            "doc_id": article["id"],
-            "doc_name": article["title"],
-            "doc_last_updated": article["updated_at"],
-            "source_id": str(source["id"])
-        } for article in articles
-    ]
+    articles = []
+    next_url = None
+    for page, next_url, end_time in iter_zendesk_hc_article_pages(url, header):
+        articles.extend([
+            {
+                "owner": str(source["owner"]),
+                "doc_type": "zendesk_help_center_article",
+                "doc_id": article["id"],
+                "doc_name": article["title"],
+                "doc_last_updated": article["updated_at"],
+                "source_id": str(source["id"])
+            } for article in page
+        ])
+        if end_time:
+            extra["hc_end_time"] = end_time
+        # Only stop on a page boundary so the checkpoint never skips articles.
+        if len(articles) >= limit:
+            break
+    extra["hc_next_page"] = next_url
+    if not next_url:
+        sync_started = extra.pop("hc_sync_started", None)
+        extra["hc_start_time"] = extra.pop("hc_end_time", None) or sync_started
+    return articles, extra
 
 
-def get_zendesk_tickets(source):
+def get_zendesk_tickets(source, extra, since):
     subdomain, access_token = get_zendesk_credentials(source)
     bearer_token = f"Bearer {access_token}"
     header = {'Authorization': bearer_token}
-    extra = json.loads(source["extra"]).copy()
+    extra = extra.copy()
     next_link = extra.get("next_link")
     has_more = extra.get("has_more")
     initial_index_completed = extra.get("initial_index_completed", False)
-    source_last_updated = source["updated"]
     user_url = f"https://{subdomain}/api/v2/users/me.json"
     user_id = requests.get(user_url, headers=header).json()["user"]["id"]
     if next_link and has_more:
@@ -119,7 +372,7 @@ def get_zendesk_tickets(source):
         ticket_last_updated_dt = pytz.utc.localize(datetime.datetime.strptime(ticket_last_updated, "%Y-%m-%dT%H:%M:%SZ"))
         is_resolved = result["status"] in ["solved", "closed"]
         updated_within_ninety_days = (current_dt - ticket_last_updated_dt).days <= 90
-        recently_updated = ticket_last_updated_dt > source_last_updated
+        recently_updated = ticket_last_updated_dt > since
         if is_resolved and ((updated_within_ninety_days and not initial_index_completed) or (recently_updated and initial_index_completed)):
             tickets.append({
                 "owner": str(source["owner"]),
@@ -141,53 +394,113 @@ def get_zendesk_tickets(source):
 
 
 
-def hubspot_article_recently_updated(doc_lasted_updated):
-    doc_lasted_updated_dt =  pytz.utc.localize(datetime.datetime.strptime(doc_lasted_updated, "%Y-%m-%dT%H:%M:%SZ"))
-    recently_updated = (datetime.datetime.now(datetime.timezone.utc) - doc_lasted_updated_dt).days <= 2
-    return recently_updated
-
-
 def get_hubspot_article_documents(engine, owner):
     with engine.connect() as connection:
-        document = connection.execute(
-            text(f"select doc_id from document where owner = '{owner}' and type = 'hubspot_help_center_article'")
+        documents = connection.execute(
+            text(f"select doc_id, doc_last_updated from document where owner = '{owner}' and type = 'hubspot_help_center_article'")
         ).fetchall()
-    return document
+    return {document["doc_id"]: document["doc_last_updated"] for document in documents}
 
 
-def get_hubspot_hc_articles(engine, source): 
-    extra = json.loads(source['extra']) if source['extra'] else {}
+def get_pending_doc_ids(engine, source_id, doc_type):
+    with engine.connect() as connection:
+        rows = connection.execute(
+            text("""
+                select doc_id from pending_document
+                where source_id = :source_id and type = :doc_type and lease_expires > now()
+            """),
+            {"source_id": str(source_id), "doc_type": doc_type}
+        ).fetchall()
+    return {row.doc_id for row in rows}
+
+
+def iter_sitemap_urls(stream):
+    """Incrementally yield (loc, lastmod) for each <url> entry of a sitemap."""
+    for _, element in etree.iterparse(stream, events=("end",), tag="{*}url"):
+        loc = element.findtext("{*}loc")
+        lastmod = element.findtext("{*}lastmod")
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if loc and lastmod:
+            yield loc.strip(), lastmod.strip()
+
+
+def parse_w3c_datetime(value):
+    """Parse a sitemap lastmod. W3C datetimes range from a bare year to a full timestamp with an offset."""
+    if len(value) == 4:
+        value += "-01-01"
+    elif len(value) == 7:
+        value += "-01"
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(pytz.utc)
+
+
+def get_hubspot_hc_articles(engine, source, extra, limit=UPSERT_LIMIT):
+    """Changed articles from the help center sitemap, at most limit of them.
+
+    When the limit cuts the sitemap short, the validators are dropped so the
+    next run fetches it in full again. Articles still pending are skipped, so
+    that run picks up where this one stopped.
+    """
     subdomain = extra.get("subdomain")
     if not subdomain:
         raise Exception("subdomain need to be provided")
+    extra = extra.copy()
     sitemap_url = f"https://{subdomain}/sitemap.xml"
-    content = requests.get(sitemap_url).content
-    soup = bs4.BeautifulSoup(content, features="xml")
-    urls = soup.find_all("url")
+    headers = {}
+    if extra.get("sitemap_etag"):
+        headers["If-None-Match"] = extra["sitemap_etag"]
+    if extra.get("sitemap_last_modified"):
+        headers["If-Modified-Since"] = extra["sitemap_last_modified"]
     articles = []
-    owner = str(source["owner"])
-    hs_article_ids = {doc["doc_id"] for doc in get_hubspot_article_documents(engine, owner)}
-    for url in urls:
-        dt = datetime.datetime.strptime(str(url.find("lastmod").string), "%Y-%m-%d")
-        doc_lasted_updated = datetime.datetime.strftime(dt, "%Y-%m-%dT%H:%M:%SZ")
-        link = str(url.find("loc").string)
-        doc_id = link.split("/")[-1]
-        if hubspot_article_recently_updated(doc_lasted_updated) or doc_id not in hs_article_ids:
-            doc_name = " ".join([word.capitalize() for word in link.split("/")[-1].split("-")])
+    with requests.get(sitemap_url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return articles, extra
+        response.raise_for_status()
+        response.raw.decode_content = True
+        owner = str(source["owner"])
+        stored = get_hubspot_article_documents(engine, owner)
+        pending = get_pending_doc_ids(engine, source["id"], "hubspot_help_center_article")
+        truncated = False
+        for link, lastmod in iter_sitemap_urls(response.raw):
+            if len(articles) >= limit:
+                truncated = True
+                break
+            try:
+                dt = parse_w3c_datetime(lastmod)
+            except ValueError:
+                logger.warning(f"Skipping {link} with invalid lastmod {lastmod}")
+                continue
+            doc_id = link.split("/")[-1]
+            stored_last_updated = stored.get(doc_id)
+            if stored_last_updated is not None and dt <= stored_last_updated:
+                continue
+            if doc_id in pending:
+                continue
+            doc_name = " ".join([word.capitalize() for word in doc_id.split("-")])
             articles.append({
                 "owner": owner,
                 "doc_type": "hubspot_help_center_article",
                 "doc_id": doc_id,
                 "doc_url": link,
                 "doc_name": doc_name,
-                "doc_last_updated": doc_lasted_updated,
+                "doc_last_updated": datetime.datetime.strftime(dt, "%Y-%m-%dT%H:%M:%SZ"),
                 "source_id": str(source["id"])
             })
-    return articles
-
+        extra["sitemap_truncated"] = truncated
+        if truncated:
+            extra.pop("sitemap_etag", None)
+            extra.pop("sitemap_last_modified", None)
+        else:
+            extra["sitemap_etag"] = response.headers.get("ETag")
+            extra["sitemap_last_modified"] = response.headers.get("Last-Modified")
+    return articles, extra
 
 
-def get_hubspot_tickets(source):
+def get_hubspot_tickets(source, extra, since):
     access_token = get_hubspot_access_token(source)
     headers = {
         "accept": "application/json",
@@ -195,10 +508,11 @@ def get_hubspot_tickets(source):
     }
     portal_id = requests.get("https://api.hubapi.com/account-info/v3/details", headers=headers).json()["portalId"]
     url = "https://api.hubapi.com/crm/v3/objects/tickets/search"
-    extra = json.loads(source["extra"]).copy()
+    extra = extra.copy()
+    extra["portal_id"] = portal_id
     after = extra.get("after", 0)
     initial_index_completed = extra.get("initial_index_completed", False)
-    source_last_updated = round(source["updated"].timestamp()*1000)
+    source_last_updated = round(since.timestamp()*1000)
     if not initial_index_completed:
         payload = {
             "sorts": ["-hs_lastmodifieddate"],
@@ -257,46 +571,298 @@ def get_hubspot_tickets(source):
     return tickets, extra
 
 
-def generate_messages(documents):
+def claim_documents(engine, documents, lease_minutes=PENDING_LEASE_MINUTES):
+    """Record documents in the pending ledger and return those not already in flight.
+
+    A document that is already pending keeps its lease. Its doc_last_updated is
+    moved forward so the worker stores the newest timestamp. Each row keeps the
+    document's descriptor, so requeue_documents can send it again on its own.
+    Expired rows from before descriptors were stored are dropped first.
+    """
+    if not documents:
+        return []
+    params = {
+        "source_ids": [document["source_id"] for document in documents],
+        "doc_types": [document["doc_type"] for document in documents],
+        "doc_ids": [str(document["doc_id"]) for document in documents],
+        "doc_last_updated": [document["doc_last_updated"] for document in documents],
+        "descriptors": [json.dumps(document) for document in documents],
+        "minutes": lease_minutes,
+    }
+    candidates = """
+        unnest(
+            cast(:source_ids as uuid[]),
+            cast(:doc_types as varchar[]),
+            cast(:doc_ids as varchar[]),
+            cast(:doc_last_updated as timestamptz[]),
+            cast(:descriptors as jsonb[])
+        ) as d(source_id, type, doc_id, doc_last_updated, descriptor)
+    """
+    with engine.begin() as connection:
+        connection.execute(text("delete from pending_document where lease_expires < now() and descriptor is null"))
+        connection.execute(text(f"""
+            update pending_document p
+            set doc_last_updated = greatest(p.doc_last_updated, d.doc_last_updated),
+                descriptor = d.descriptor
+            from {candidates}
+            where p.source_id = d.source_id and p.type = d.type and p.doc_id = d.doc_id
+        """), params)
+        claimed = connection.execute(text(f"""
+            insert into pending_document (source_id, type, doc_id, doc_last_updated, lease_expires, descriptor)
+            select d.source_id, d.type, d.doc_id, d.doc_last_updated, now() + make_interval(mins => :minutes), d.descriptor
+            from {candidates}
+            on conflict do nothing
+            returning source_id, type, doc_id
+        """), params).fetchall()
+    claimed_keys = {(str(row.source_id), row.type, row.doc_id) for row in claimed}
+    claimed_documents = []
+    for document in documents:
+        key = (document["source_id"], document["doc_type"], str(document["doc_id"]))
+        if key in claimed_keys:
+            claimed_keys.remove(key)
+            claimed_documents.append(document)
+    return claimed_documents
+
+
+def generate_messages(documents, max_documents=DOCUMENTS_PER_MESSAGE, max_bytes=MAX_MESSAGE_BYTES):
+    """Pack document descriptors into as few SQS message entries as possible."""
     messages = []
+    packed = []
+    size = len('{"documents": []}')
     for document in documents:
-        messages.append({
-            "MessageBody": json.dumps(document),
+        document_str = json.dumps(document)
+        document_size = len(document_str.encode("utf-8")) + 2
+        if packed and (len(packed) >= max_documents or size + document_size > max_bytes):
+            messages.append(packed)
+            packed = []
+            size = len('{"documents": []}')
+        packed.append(document_str)
+        size += document_size
+    if packed:
+        messages.append(packed)
+    return [
+        {
+            "MessageBody": '{"documents": [' + ", ".join(message) + "]}",
             "Id": str(uuid.uuid4())
-        })
-    return messages
+        } for message in messages
+    ]
+
+
+def send_messages(sqs, queue_url, messages):
+    """Send message entries in batches of 10. Returns the entries that were not enqueued."""
+    def send_batch(entries):
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed_ids = set()
+        for failure in response.get("Failed", []):
+            logger.error(f"Failed to enqueue message {failure['Id']}: {failure.get('Message')}")
+            failed_ids.add(failure["Id"])
+        return [entry for entry in entries if entry["Id"] in failed_ids]
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as executor:
+        futures = {executor.submit(send_batch, list(chunk)): chunk for chunk in chunks(messages, batch_size=10)}
+        for future in as_completed(futures):
+            try:
+                failed.extend(future.result())
+            except Exception as e:
+                logger.error(str(e))
+                failed.extend(futures[future])
+    return failed
+
+
+def requeue_documents(engine, limit, lease_minutes=PENDING_LEASE_MINUTES):
+    """Take up to limit ledger rows that need sending again and renew their leases.
+
+    These are documents the worker saw change while it was indexing them, and
+    documents whose lease ran out because their message was lost or failed.
+    The source cursors have already moved past them, so the ledger is the only
+    record that they still need indexing. Returns their descriptors.
+    """
+    if limit <= 0:
+        return []
+    with engine.begin() as connection:
+        rows = connection.execute(
+            text("""
+                update pending_document p
+                set needs_reindex = false, lease_expires = now() + make_interval(mins => :minutes)
+                from (
+                    select source_id, type, doc_id from pending_document
+                    where descriptor is not null and (needs_reindex or lease_expires < now())
+                    order by lease_expires
+                    limit :limit
+                    for update skip locked
+                ) d
+                where p.source_id = d.source_id and p.type = d.type and p.doc_id = d.doc_id
+                returning p.descriptor, p.doc_last_updated
+            """),
+            {"limit": limit, "minutes": lease_minutes}
+        ).fetchall()
+    documents = []
+    for row in rows:
+        document = dict(row.descriptor)
+        if row.doc_last_updated:
+            document["doc_last_updated"] = row.doc_last_updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+        documents.append(document)
+    return documents
+
+
+def expire_documents(engine, messages):
+    """Expire the leases of documents in messages that were never enqueued.
+
+    requeue_documents sends them again on the next run.
+    """
+    documents = [document for message in messages for document in json.loads(message["MessageBody"])["documents"]]
+    if not documents:
+        return
+    with engine.begin() as connection:
+        connection.execute(
+            text("""
+                update pending_document p set lease_expires = now()
+                from unnest(
+                    cast(:source_ids as uuid[]),
+                    cast(:doc_types as varchar[]),
+                    cast(:doc_ids as varchar[])
+                ) as d(source_id, type, doc_id)
+                where p.source_id = d.source_id and p.type = d.type and p.doc_id = d.doc_id
+            """),
+            {
+                "source_ids": [document["source_id"] for document in documents],
+                "doc_types": [document["doc_type"] for document in documents],
+                "doc_ids": [str(document["doc_id"]) for document in documents],
+            }
+        )
+
+
+def send_documents(engine, sqs, queue_url, documents):
+    """Send documents that are already claimed in the pending ledger to the worker queue."""
+    messages = generate_messages(documents)
+    logger.info(f"Upserting {len(documents)} docs in {len(messages)} messages")
+    failed = send_messages(sqs, queue_url, messages)
+    if failed:
+        logger.error(f"Expiring the leases of {len(failed)} messages that were not enqueued")
+        expire_documents(engine, failed)
+
+
+def enqueue_documents(engine, sqs, queue_url, documents):
+    """Claim documents in the pending ledger and send the claimed ones to the worker queue."""
+    claimed = claim_documents(engine, documents)
+    logger.info(f"Skipping {len(documents) - len(claimed)} docs that are already pending")
+    send_documents(engine, sqs, queue_url, claimed)
+
+
+def sync_source(engine, source, extra, limit, now):
+    """Collect changed documents for one source, returning them with its updated extra.
+
+    Doc types that receive webhooks are skipped until a reconciliation is due.
+    A reconciliation looks back to the previous one, not to the last sync,
+    because syncs of the other doc types move source.updated in between.
+
+    Fetches stop once limit documents are collected. Ticket fetches left out
+    that way keep their lookback in deferred_since for the next run.
+    """
+    covered = set(extra.get("webhook_doc_types", []))
+    reconcile = bool(covered) and hours_since_reconcile(extra, now) >= RECONCILE_INTERVAL_HOURS
+    since = source["updated"]
+    if reconcile and extra.get("reconciled"):
+        since = datetime.datetime.fromtimestamp(extra["reconciled"], datetime.timezone.utc)
+    if extra.get("deferred_since"):
+        deferred_since = datetime.datetime.fromtimestamp(extra["deferred_since"], datetime.timezone.utc)
+        since = min(since, deferred_since) if since else deferred_since
+
+    documents = []
+    skipped = False
+
+    def due(doc_type):
+        """Whether to fetch doc_type now. Every fetch counts towards limit."""
+        nonlocal skipped
+        if doc_type in covered and not reconcile:
+            return False
+        if len(documents) >= limit:
+            skipped = True
+            return False
+        return True
+
+    if source.name == "zendesk_integration":
+        if due("zendesk_help_center_article"):
+            articles, extra = get_zendesk_hc_articles(source, extra, limit=limit - len(documents))
+            documents.extend(articles)
+        if due("zendesk_ticket"):
+            tickets, extra = get_zendesk_tickets(source, extra, since)
+            documents.extend(tickets)
+    elif source.name == "hubspot_integration":
+        if due("hubspot_help_center_article"):
+            articles, extra = get_hubspot_hc_articles(engine, source, extra, limit=limit - len(documents))
+            documents.extend(articles)
+        if due("hubspot_ticket"):
+            tickets, extra = get_hubspot_tickets(source, extra, since)
+            documents.extend(tickets)
+    if skipped and since:
+        extra["deferred_since"] = since.timestamp()
+    else:
+        extra.pop("deferred_since", None)
+    # A reconciliation cut short by the budget is retried on the next run.
+    if reconcile and not skipped:
+        extra["reconciled"] = now.timestamp()
+    return documents, extra
 
 
 def handler(event, context):
     engine = create_engine(os.environ["SQLALCHEMY_DATABASE_URL"])
-    sqs = boto3.resource("sqs", region_name="us-east-1")
-    queue = sqs.get_queue_by_name(QueueName=os.getenv("SQS_QUEUE_NAME"))
+    sqs = boto3.client("sqs", region_name="us-east-1", endpoint_url=os.getenv("SQS_ENDPOINT_URL"))
+    queue_url = sqs.get_queue_url(QueueName=os.getenv("SQS_QUEUE_NAME"))["QueueUrl"]
     body = json.loads(event["body"]) if event.get("body") else {}
+    if "documents" in body:
+        # Sent by the API's webhook endpoints. Changes pushed by the source skip the budget.
+        enqueue_documents(engine, sqs, queue_url, body["documents"])
+        engine.dispose()
+        return
     documents = []
     source_id = body.get("source_id")
-    sources = get_sources(engine, source_id=source_id)
-    for source in sources:
+    budget = get_upsert_budget(engine)
+    if source_id:
+        # A newly connected source should always start syncing.
+        budget = max(budget, MIN_UPSERT_LIMIT)
+    if budget == 0:
+        logger.info("Worker is saturated, skipping run")
+        engine.dispose()
+        return
+    requeued = [] if source_id else requeue_documents(engine, budget)
+    if requeued:
+        logger.info(f"Requeueing {len(requeued)} docs from the pending ledger")
+        send_documents(engine, sqs, queue_url, requeued)
+        budget -= len(requeued)
+        if budget <= 0:
+            engine.dispose()
+            return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if source_id:
+        sources = [(source, json.loads(source["extra"]) if source["extra"] else {}) for source in get_sources(engine, [source_id])]
+    else:
+        sources = prioritize_sources(engine, now)
+    synced = []
+    for source, extra in sources:
+        backlog = has_backlog(extra)
         try:
-            if source.name == "zendesk_integration":
-                articles = get_zendesk_hc_articles(source)
-                documents.extend(articles)
-                tickets, extra = get_zendesk_tickets(source)
-                documents.extend(tickets)
-                update_source(engine, source, extra)
-            elif source.name == "hubspot_integration":
-                articles = get_hubspot_hc_articles(engine, source)
-                documents.extend(articles)
-                tickets, extra = get_hubspot_tickets(source)
-                documents.extend(tickets)
-                update_source(engine, source, extra)
+            source_documents, extra = sync_source(engine, source, extra, budget - len(documents), now)
         except Exception as e:
             logger.error(str(e))
-        if len(documents) > UPSERT_LIMIT:
+            record_source_failure(engine, source)
+            continue
+        documents.extend(source_documents)
+        # Backlog pages are history, not new changes, so they do not count towards the rate.
+        if not backlog:
+            extra = update_change_rate(source, extra, len(source_documents), now)
+        extra.pop("failures", None)
+        extra.pop("last_failure", None)
+        synced.append((source, extra))
+        if len(documents) >= budget:
             break
 
-    messages = generate_messages(documents)
-    logger.info(f"Upserting {len(messages)} docs")
-    for chunk in chunks(messages, batch_size=10):
-        queue.send_messages(Entries=chunk)
+    enqueue_documents(engine, sqs, queue_url, documents)
+    # Cursors and sitemap validators move forward only once the documents they
+    # cover are in the pending ledger. If the run dies first, the next one
+    # fetches them again.
+    for source, extra in synced:
+        update_source(engine, source, extra)
 
     engine.dispose()
\ No newline at end of file
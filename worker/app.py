@@ -1,3 +1,4 @@
+from collections import defaultdict
 import datetime
 import itertools
 import logging
@@ -14,9 +15,28 @@ import requests
 from sentence_transformers import SentenceTransformer
 from sqlalchemy import create_engine, text
 
+from compact import release_chunks
+from dedup import mark_duplicates, record_fingerprints
+from pipeline import Stage, run_pipeline
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 16))
+# (connect, read) seconds. A hung request would otherwise hold a fetch thread,
+# and the daemon's message, forever.
+HTTP_TIMEOUT = (5.0, float(os.getenv("HTTP_TIMEOUT", 30)))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 8))
+# Chunks per encode call, and per batch of upserts.
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", 256))
+UPSERT_BATCH_SIZE = 100
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 32))
+
+# Shared across invocations of a warm container and across daemon fetch
+# threads, so connections to the same Zendesk or HubSpot host are reused.
+http = requests.Session()
+http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
 
 def chunks(iterable, batch_size=100):
     """A helper function to break an iterable into chunks of size batch_size."""
@@ -35,6 +55,14 @@ def get_record_body(record):
     return record_body
 
 
+def get_record_documents(record):
+    """Unpack the document descriptors carried by an SQS record."""
+    record_body = get_record_body(record)
+    if "documents" in record_body:
+        return record_body["documents"]
+    return [record_body]
+
+
 def get_source(engine, source_id):
     with engine.connect() as connection:
         source = connection.execute(
@@ -50,16 +78,21 @@ def get_credentials(source):
     return subdomain, access_token
 
 
-def get_zendesk_help_center_article(source, doc_id):
+def fetch_zendesk_help_center_article(source, doc_id):
     subdomain, access_token = get_credentials(source)
     if not subdomain and not access_token:
         return
-    source_id = source.id
     url = f"https://{subdomain}/api/v2/help_center/articles/{doc_id}.json"
     bearer_token = f"Bearer {access_token}"
     header = {'Authorization': bearer_token}
-    data = requests.get(url, headers=header).json()
-    article = data["article"]
+    response = http.get(url, headers=header, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["article"]
+
+
+def parse_zendesk_help_center_article(source, doc_id, article):
+    subdomain, _ = get_credentials(source)
+    source_id = source.id
     article_title = article["title"]
     article_url = article["html_url"]
     article_last_updated = article["updated_at"]
@@ -120,10 +153,15 @@ def get_zendesk_help_center_article(source, doc_id):
     return results
 
 
-def get_hubspot_help_center_article(source, doc_id, doc_url, doc_name, doc_last_updated):
+def fetch_hubspot_help_center_article(doc_url):
+    response = http.get(doc_url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def parse_hubspot_help_center_article(source, doc_id, doc_url, doc_name, doc_last_updated, page_content):
     source_id = source.id
     subdomain = json.loads(source['extra'])["subdomain"]
-    page_content = requests.get(doc_url).content
     soup = BeautifulSoup(page_content, "html.parser")
     kb_content = str(soup.find("div", {"class": "kb-article"}))
     seg = pysbd.Segmenter(language="en", clean=True)
@@ -170,16 +208,26 @@ def get_hubspot_help_center_article(source, doc_id, doc_url, doc_name, doc_last_
     return results
 
 
-def get_zendesk_ticket(source, doc_id):
+def fetch_zendesk_ticket(source, doc_id):
     subdomain, access_token = get_credentials(source)
     if not subdomain and not access_token:
         return
-    source_id = source.id
     url = f"https://{subdomain}/api/v2/tickets/{doc_id}.json"
     bearer_token = f"Bearer {access_token}"
     header = {'Authorization': bearer_token}
-    data = requests.get(url, headers=header).json()
-    ticket = data["ticket"]
+    response = http.get(url, headers=header, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    ticket = response.json()["ticket"]
+    url = f"https://{subdomain}/api/v2/tickets/{doc_id}/comments?page[size]=100&sort=-created_at"
+    response = http.get(url, headers=header, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    comments = response.json().get("comments", [])
+    return ticket, comments
+
+
+def parse_zendesk_ticket(source, doc_id, ticket, comments):
+    subdomain, _ = get_credentials(source)
+    source_id = source.id
     assignee_id = ticket["assignee_id"]
     subject = unicodedata.normalize("NFKD", ticket["subject"])
     description = unicodedata.normalize("NFKD", ticket["description"])
@@ -199,8 +247,6 @@ def get_zendesk_ticket(source, doc_id):
             "doc_labels": ticket_labels,
         }
     ]
-    url = f"https://{subdomain}/api/v2/tickets/{doc_id}/comments?page[size]=100&sort=-created_at"
-    comments = requests.get(url, headers=header).json().get("comments", [])
     for idx, comment in enumerate(comments[1:]):
         if comment.get("author_id") == assignee_id:
             results.append(
@@ -229,21 +275,26 @@ def get_hubspot_access_token(source):
         "redirect_uri": os.getenv("HUBSPOT_REDIRECT_URI"),
         "refresh_token": refresh_token
     }
-    r = requests.post("https://api.hubapi.com/oauth/v1/token", data=parameters)
+    r = http.post("https://api.hubapi.com/oauth/v1/token", data=parameters, timeout=HTTP_TIMEOUT)
     data = r.json()
     access_token = data["access_token"]
     return access_token
 
 
-def get_hubspot_ticket(source, doc_id, portal_id):
-    source_id = source.id
+def fetch_hubspot_ticket(source, doc_id):
     access_token = get_hubspot_access_token(source)
     headers = {
         "accept": "application/json",
         "Authorization": f"Bearer {access_token}"
     }
     url = f"https://api.hubapi.com/crm/v3/objects/tickets/{doc_id}"
-    response = requests.get(url, headers=headers).json()
+    response = http.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def parse_hubspot_ticket(source, doc_id, portal_id, response):
+    source_id = source.id
     subdomain = json.loads(source['extra'])["subdomain"]
     description = response["properties"]["content"]
     subject = response["properties"]["subject"]
@@ -265,8 +316,11 @@ def get_hubspot_ticket(source, doc_id, portal_id):
     return results
 
 
-def index_documents(index, bi_encoder, results):
-    text_embeddings = bi_encoder.encode([result["text_to_index"] for result in results]).tolist()
+def encode_results(bi_encoder, results):
+    return bi_encoder.encode([result["text_to_index"] for result in results]).tolist()
+
+
+def upsert_results(index, results, text_embeddings):
     upsert_data_generator = map(lambda i: (
         results[i]["id"],
         text_embeddings[i],
@@ -278,13 +332,19 @@ def index_documents(index, bi_encoder, results):
             "doc_url": results[i]["doc_url"],
             "doc_name": results[i]["doc_name"],
             "doc_labels": results[i]["doc_labels"],
+            "doc_refs": results[i].get("doc_refs") or [results[i]["doc_url"]],
         }), range(len(results))
     )
     for ids_vectors_chunk in chunks(upsert_data_generator, batch_size=100):
         index.upsert(vectors=ids_vectors_chunk, namespace=os.environ["PINECONE_NAMESPACE"])
 
 
-def store_document(engine, doc_id, owner, doc_type, doc_name, doc_last_updated):
+def index_documents(index, bi_encoder, results):
+    upsert_results(index, results, encode_results(bi_encoder, results))
+
+
+def store_document(engine, doc_id, owner, doc_type, doc_name, doc_last_updated, source_id, chunk_ids):
+    params = {"doc_name": doc_name, "source_id": str(source_id), "chunk_ids": chunk_ids}
     with engine.connect() as connection:
         document = connection.execute(
             text(f"select id from document where doc_id = '{doc_id}' and owner = '{owner}' and type = '{doc_type}'")
@@ -292,9 +352,305 @@ def store_document(engine, doc_id, owner, doc_type, doc_name, doc_last_updated):
         current = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
         if not document:
             doc_pk = str(uuid.uuid4())
-            connection.execute(text(f"insert into document (id, owner, name, type, doc_id, doc_last_updated, created) values ('{doc_pk}', '{owner}', :doc_name, '{doc_type}', '{doc_id}', '{doc_last_updated}'::timestamp with TIME ZONE, '{current}'::timestamp with TIME ZONE)"), {"doc_name": doc_name})
+            connection.execute(text(f"insert into document (id, owner, name, type, doc_id, doc_last_updated, created, source_id, chunk_ids) values ('{doc_pk}', '{owner}', :doc_name, '{doc_type}', '{doc_id}', '{doc_last_updated}'::timestamp with TIME ZONE, '{current}'::timestamp with TIME ZONE, :source_id, cast(:chunk_ids as text[]))"), params)
         else:
-            connection.execute(text(f"update document SET updated = '{current}'::timestamp with TIME ZONE, doc_last_updated = '{doc_last_updated}'::timestamp with TIME ZONE where id = '{document.id}'"))
+            connection.execute(text(f"update document SET updated = '{current}'::timestamp with TIME ZONE, doc_last_updated = '{doc_last_updated}'::timestamp with TIME ZONE, source_id = :source_id, chunk_ids = cast(:chunk_ids as text[]) where id = '{document.id}'"), params)
+
+
+def get_document_chunk_ids(engine, doc_id, owner, doc_type):
+    with engine.connect() as connection:
+        document = connection.execute(
+            text("select chunk_ids from document where doc_id = :doc_id and owner = :owner and type = :doc_type"),
+            {"doc_id": str(doc_id), "owner": str(owner), "doc_type": doc_type}
+        ).fetchone()
+    return document.chunk_ids if document else None
+
+
+def delete_document(engine, doc_id, owner, doc_type):
+    with engine.begin() as connection:
+        connection.execute(
+            text("delete from document where doc_id = :doc_id and owner = :owner and type = :doc_type"),
+            {"doc_id": str(doc_id), "owner": str(owner), "doc_type": doc_type}
+        )
+
+
+def record_completions(engine, count):
+    """Count finished documents towards the scheduler's throughput estimate."""
+    if not count:
+        return
+    with engine.begin() as connection:
+        connection.execute(
+            text("""
+                insert into worker_completion (minute, count) values (date_trunc('minute', now()), :count)
+                on conflict (minute) do update set count = worker_completion.count + excluded.count
+            """),
+            {"count": count}
+        )
+
+
+def get_pending_document(engine, source_id, doc_type, doc_id, doc_last_updated):
+    """Look up the pending ledger entry, coalescing to the newest doc_last_updated seen."""
+    with engine.connect() as connection:
+        return connection.execute(
+            text("""
+                select doc_last_updated,
+                       greatest(doc_last_updated, cast(:doc_last_updated as timestamptz)) as latest
+                from pending_document
+                where source_id = :source_id and type = :doc_type and doc_id = :doc_id
+            """),
+            {"source_id": str(source_id), "doc_type": doc_type, "doc_id": str(doc_id), "doc_last_updated": doc_last_updated}
+        ).fetchone()
+
+
+def release_pending_document(engine, source_id, doc_type, doc_id, seen_last_updated):
+    """Clear the ledger entry once the document has been indexed.
+
+    If the scheduler recorded a newer change while this one was processing, the
+    entry stays and is marked needs_reindex. The scheduler's requeue_documents
+    sends it again from the descriptor stored in the entry, since the source's
+    cursor has already moved past the change.
+    """
+    params = {"source_id": str(source_id), "doc_type": doc_type, "doc_id": str(doc_id), "seen": seen_last_updated}
+    with engine.begin() as connection:
+        deleted = connection.execute(
+            text("""
+                delete from pending_document
+                where source_id = :source_id and type = :doc_type and doc_id = :doc_id
+                and doc_last_updated is not distinct from :seen
+            """),
+            params
+        ).rowcount
+        if not deleted:
+            connection.execute(
+                text("""
+                    update pending_document set needs_reindex = true
+                    where source_id = :source_id and type = :doc_type and doc_id = :doc_id
+                """),
+                params
+            )
+
+
+def is_missing_document_error(error):
+    """Whether a fetch failed because the document no longer exists upstream."""
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in (404, 410)
+
+
+def fetch_document(engine, record_body):
+    """Fetch the document a queue message describes, without parsing it.
+
+    Returns None if its source is gone or the type is unknown. Otherwise returns
+    the raw response plus what parse_document and complete_document need.
+    Documents the message marks deleted are not fetched. Neither are those
+    whose fetch finds them gone (404 or 410), which are marked deleted too;
+    other HTTP errors are raised.
+    """
+    source_id = uuid.UUID(record_body["source_id"])
+    source = get_source(engine, source_id)
+    if not source:
+        return
+    doc_type = record_body["doc_type"]
+    doc_id = record_body["doc_id"]
+    doc_url = record_body.get("doc_url")
+    doc_last_updated = record_body["doc_last_updated"]
+    pending = get_pending_document(engine, source_id, doc_type, doc_id, doc_last_updated)
+    if pending:
+        doc_last_updated = pending.latest.isoformat()
+    deleted = bool(record_body.get("deleted"))
+    try:
+        if deleted:
+            raw = None
+        elif doc_type == "zendesk_help_center_article":
+            raw = fetch_zendesk_help_center_article(source, doc_id)
+        elif doc_type == "zendesk_ticket":
+            raw = fetch_zendesk_ticket(source, doc_id)
+        elif doc_type == "hubspot_help_center_article":
+            raw = fetch_hubspot_help_center_article(doc_url)
+        elif doc_type == "hubspot_ticket":
+            raw = fetch_hubspot_ticket(source, doc_id)
+        else:
+            return
+    except requests.HTTPError as e:
+        # A document deleted upstream is done with; anything else is worth retrying.
+        if not is_missing_document_error(e):
+            raise
+        logger.info(f"{doc_type} {doc_id} is gone: {e}")
+        raw = None
+        deleted = True
+    return {
+        "source": source,
+        "source_id": source_id,
+        "owner": source["owner"],
+        "doc_type": doc_type,
+        "doc_id": doc_id,
+        "doc_url": doc_url,
+        "doc_name": record_body.get("doc_name"),
+        "doc_last_updated": doc_last_updated,
+        "portal_id": record_body.get("portal_id"),
+        "pending": pending,
+        "deleted": deleted,
+        "raw": raw,
+        "results": None,
+    }
+
+
+def parse_document(document):
+    """Chunk a fetched document into document["results"]."""
+    source = document["source"]
+    doc_type = document["doc_type"]
+    doc_id = document["doc_id"]
+    raw = document.pop("raw")
+    if raw is None:
+        return document
+    if doc_type == "zendesk_help_center_article":
+        results = parse_zendesk_help_center_article(source, doc_id, raw)
+    elif doc_type == "zendesk_ticket":
+        results = parse_zendesk_ticket(source, doc_id, *raw)
+    elif doc_type == "hubspot_help_center_article":
+        results = parse_hubspot_help_center_article(
+            source, doc_id, document["doc_url"], document["doc_name"], document["doc_last_updated"], raw
+        )
+    else:
+        results = parse_hubspot_ticket(source, doc_id, document["portal_id"], raw)
+    if results:
+        # Webhook events may not carry a name; fall back to the fetched title.
+        document["doc_name"] = document["doc_name"] or results[0]["doc_name"]
+    document["results"] = results
+    return document
+
+
+def complete_document(engine, document):
+    """Record an indexed document, or forget a deleted one, and clear its pending ledger entry."""
+    if document["deleted"]:
+        delete_document(engine, document["doc_id"], document["owner"], document["doc_type"])
+    elif document["results"]:
+        store_document(
+            engine,
+            document["doc_id"],
+            document["owner"],
+            document["doc_type"],
+            document["doc_name"],
+            document["doc_last_updated"],
+            document["source_id"],
+            [result["id"] for result in document["results"]],
+        )
+    pending = document["pending"]
+    if pending:
+        release_pending_document(
+            engine, document["source_id"], document["doc_type"], document["doc_id"], pending.doc_last_updated
+        )
+
+
+def release_stale_chunks(engine, index, documents):
+    """Delete the vectors of chunks that documents had when last indexed but no longer have.
+
+    A deleted document has none left. Call before complete_document
+    overwrites or deletes their chunk_ids.
+    """
+    stale = defaultdict(list)
+    keep = set()
+    for document in documents:
+        if not document["results"] and not document["deleted"]:
+            continue
+        current = {result["id"] for result in document["results"] or []}
+        keep.update(result["duplicate_of"] for result in document["results"] or [] if result.get("duplicate_of"))
+        previous = get_document_chunk_ids(engine, document["doc_id"], document["owner"], document["doc_type"])
+        stale[document["source_id"]].extend(vector_id for vector_id in previous or [] if vector_id not in current)
+    for source_id, vector_ids in stale.items():
+        release_chunks(engine, index, source_id, vector_ids, keep)
+
+
+def get_indexed_results(document):
+    """The chunks that get their own vector, leaving out near-duplicates of other chunks."""
+    return [result for result in document["results"] or [] if not result.get("duplicate_of")]
+
+
+def process_document(engine, index, bi_encoder, record_body):
+    document = fetch_document(engine, record_body)
+    if document is None:
+        return
+    parse_document(document)
+    mark_duplicates(engine, index, [document])
+    results = get_indexed_results(document)
+    if results:
+        index_documents(index, bi_encoder, results)
+    release_stale_chunks(engine, index, [document])
+    complete_document(engine, document)
+    if document["results"]:
+        record_fingerprints(engine, index, document)
+    record_completions(engine, 1)
+
+
+def count_results(item):
+    document = item["document"]
+    return len(get_indexed_results(document)) if document else 0
+
+
+def get_pipeline_stages(engine, index, bi_encoder, on_error=None):
+    """Stages that take {"record_body": ...} items from fetch through to the document row.
+
+    Items carry their document from stage to stage. One whose source is gone
+    or whose fetch found nothing still passes through, with no chunks, so
+    every item reaches the end unless a stage raises.
+    """
+    def fetch(items):
+        for item in items:
+            logger.info(item["record_body"])
+            item["document"] = fetch_document(engine, item["record_body"])
+        return items
+
+    def parse(items):
+        for item in items:
+            if item["document"]:
+                parse_document(item["document"])
+        return items
+
+    def dedup(items):
+        mark_duplicates(engine, index, [item["document"] for item in items if item["document"]])
+        return items
+
+    def encode(items):
+        results = [result for item in items if count_results(item) for result in get_indexed_results(item["document"])]
+        if results:
+            embeddings = iter(encode_results(bi_encoder, results))
+            for item in items:
+                item["embeddings"] = [next(embeddings) for _ in range(count_results(item))]
+        return items
+
+    def upsert(items):
+        results, embeddings = [], []
+        for item in items:
+            if count_results(item):
+                results.extend(get_indexed_results(item["document"]))
+                embeddings.extend(item["embeddings"])
+        if results:
+            upsert_results(index, results, embeddings)
+        return items
+
+    def complete(items):
+        documents = [item["document"] for item in items if item["document"]]
+        release_stale_chunks(engine, index, documents)
+        for document in documents:
+            complete_document(engine, document)
+            if document["results"]:
+                record_fingerprints(engine, index, document)
+        record_completions(engine, len(documents))
+        return items
+
+    return [
+        Stage("fetch", fetch, workers=FETCH_WORKERS, on_error=on_error),
+        Stage("parse", parse, on_error=on_error),
+        Stage("dedup", dedup, batch_size=ENCODE_BATCH_SIZE, weight=count_results, on_error=on_error),
+        Stage("encode", encode, batch_size=ENCODE_BATCH_SIZE, weight=count_results, on_error=on_error),
+        Stage("upsert", upsert, batch_size=UPSERT_BATCH_SIZE, weight=count_results, on_error=on_error),
+        Stage("complete", complete, batch_size=UPSERT_BATCH_SIZE, on_error=on_error),
+    ]
+
+
+def process_documents(engine, index, bi_encoder, record_bodies):
+    """Index documents with fetching, parsing, encoding and upserts running concurrently."""
+    items = ({"record_body": record_body} for record_body in record_bodies)
+    run_pipeline(items, get_pipeline_stages(engine, index, bi_encoder), queue_size=PIPELINE_QUEUE_SIZE)
 
 
 def handler(event, context):
@@ -302,36 +658,7 @@ def handler(event, context):
     pinecone.init(api_key=PINECONE_KEY, environment="us-west1-gcp")
     index = pinecone.Index(index_name="semantic-text-search")
     bi_encoder = SentenceTransformer("/mnt/bi_encoder")
-    engine = create_engine(os.environ["SQLALCHEMY_DATABASE_URL"])
-    for record in event['Records']:
-        record_body = get_record_body(record)
-        logger.info(record_body)
-        try:
-            source_id = uuid.UUID(record_body["source_id"])
-            source = get_source(engine, source_id)
-            if not source:
-                continue
-            owner = source["owner"]
-            doc_type = record_body["doc_type"]
-            doc_id = record_body["doc_id"]
-            doc_url = record_body.get("doc_url")
-            doc_name = record_body["doc_name"]
-            doc_last_updated = record_body["doc_last_updated"]
-            results = None
-            if doc_type == "zendesk_help_center_article":
-                results = get_zendesk_help_center_article(source, doc_id)
-            elif doc_type == "zendesk_ticket":
-                results = get_zendesk_ticket(source, doc_id)
-            elif doc_type == "hubspot_help_center_article":
-                results = get_hubspot_help_center_article(source, doc_id, doc_url, doc_name, doc_last_updated)
-            elif doc_type == "hubspot_ticket":
-                portal_id = record_body["portal_id"]
-                results = get_hubspot_ticket(source, doc_id, portal_id)
-            else:
-                continue
-            if results:
-                index_documents(index, bi_encoder, results)
-                store_document(engine, doc_id, owner, doc_type, doc_name, doc_last_updated)
-        except Exception as e:
-            logger.error(e)
-    engine.dispose()
\ No newline at end of file
+    engine = create_engine(os.environ["SQLALCHEMY_DATABASE_URL"], pool_size=FETCH_WORKERS + 1)
+    record_bodies = (record_body for record in event['Records'] for record_body in get_record_documents(record))
+    process_documents(engine, index, bi_encoder, record_bodies)
+    engine.dispose()
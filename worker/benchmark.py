@@ -0,0 +1,332 @@
+"""Measure worker ingestion throughput against recorded fixtures.
+
+Documents go through the same process_documents pipeline as the Lambda
+handler: fetch, BeautifulSoup/pysbd chunking, encoding, upsert and
+store_document.
+Zendesk and HubSpot responses are served from fixtures/ by a local stub server.
+Vectors go to an in-memory sink. Postgres (SQLALCHEMY_DATABASE_URL) gets a
+seeded user and sources, which are deleted again when the run ends.
+
+Documents are packed into SQS-style messages of each --batch-sizes value. Each
+message goes through process_documents on its own, as one Lambda invocation
+would, so the batch size sets how many documents share a pipeline run. That
+is how many fetches overlap and how many chunks the encoder can batch
+together, against the fixed cost of starting a run. For every batch size it
+reports documents/sec, chunks/sec and the time spent in each stage. Stages
+run concurrently, so stage times add up to more than the wall-clock time; the
+largest one is the bottleneck:
+
+    python benchmark.py --documents 400 --batch-sizes 1 10 50
+    python benchmark.py --fake-encoder --compare results/ingest.json
+
+Run it from a repository checkout. It reuses the result helpers in
+backend/app/benchmarks/common.py.
+"""
+import argparse
+from collections import defaultdict
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+import uuid
+
+import requests
+from sqlalchemy import create_engine, text
+
+import app
+import dedup
+
+# After the worker imports: backend/app has its own app package, which would shadow app.py.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "app"))
+from benchmarks.common import compare_results, save_results  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+ZENDESK_SUBDOMAIN = "bench.zendesk.com"
+HUBSPOT_SUBDOMAIN = "bench.hubspot.com"
+DOC_TYPES = ["zendesk_help_center_article", "zendesk_ticket", "hubspot_help_center_article", "hubspot_ticket"]
+
+ROUTES = [
+    (r"/[^/]+/api/v2/help_center/articles/(\w+)\.json", "zendesk_article.json"),
+    (r"/[^/]+/api/v2/tickets/(\w+)\.json", "zendesk_ticket.json"),
+    (r"/[^/]+/api/v2/tickets/(\w+)/comments", "zendesk_ticket_comments.json"),
+    (r"/api\.hubapi\.com/oauth/v1/token", "hubspot_token.json"),
+    (r"/api\.hubapi\.com/crm/v3/objects/tickets/(\w+)", "hubspot_ticket.json"),
+    (r"/[^/]+/kb/(\w+)", "hubspot_article.html"),
+]
+
+
+def load_fixtures():
+    fixtures = {}
+    for _, name in ROUTES:
+        with open(os.path.join(FIXTURES_DIR, name)) as f:
+            fixtures[name] = f.read()
+    return fixtures
+
+
+def make_stub_handler(fixtures, latency):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def respond(self):
+            time.sleep(latency)
+            path = urlsplit(self.path).path
+            for pattern, name in ROUTES:
+                match = re.fullmatch(pattern, path)
+                if match:
+                    doc_id = match.group(1) if match.groups() else ""
+                    body = fixtures[name].replace("__DOC_ID__", doc_id).encode()
+                    content_type = "text/html" if name.endswith(".html") else "application/json"
+                    self.send_response(200)
+                    break
+            else:
+                body, content_type = b"{}", "application/json"
+                self.send_response(404)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.respond()
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+class Timings:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] += elapsed
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed
+
+
+class StubRequests:
+    """Stands in for app.http, sending every call to the stub server."""
+
+    def __init__(self, base_url, timings):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.timings = timings
+
+    def rewrite(self, url):
+        parts = urlsplit(url)
+        query = f"?{parts.query}" if parts.query else ""
+        return f"{self.base_url}/{parts.netloc}{parts.path}{query}"
+
+    def get(self, url, **kwargs):
+        with self.timings.stage("fetch"):
+            return self.session.get(self.rewrite(url), **kwargs)
+
+    def post(self, url, **kwargs):
+        with self.timings.stage("fetch"):
+            return self.session.post(self.rewrite(url), **kwargs)
+
+
+class InMemoryIndex:
+    def __init__(self):
+        self.vectors = {}
+
+    def upsert(self, vectors, namespace):
+        for id, values, metadata in vectors:
+            self.vectors[(namespace, id)] = (values, metadata)
+
+    def fetch(self, ids, namespace):
+        vectors = {}
+        for id in ids:
+            if (namespace, id) in self.vectors:
+                values, metadata = self.vectors[(namespace, id)]
+                vectors[id] = {"id": id, "values": values, "metadata": metadata}
+        return {"vectors": vectors}
+
+    def delete(self, ids, namespace):
+        for id in ids:
+            self.vectors.pop((namespace, id), None)
+
+    def update(self, id, set_metadata, namespace):
+        values, metadata = self.vectors[(namespace, id)]
+        self.vectors[(namespace, id)] = (values, {**metadata, **set_metadata})
+
+
+class FakeEncoder:
+    """Returns zero vectors, for measuring everything except the model."""
+
+    def __init__(self, dimension=768):
+        self.dimension = dimension
+
+    def encode(self, sentences):
+        import numpy as np
+        return np.zeros((len(sentences), self.dimension), dtype="float32")
+
+
+def install_stand_ins(base_url, timings):
+    app.http = StubRequests(base_url, timings)
+    app.parse_document = timings.wrap("parse", app.parse_document)
+    app.mark_duplicates = timings.wrap("dedup", app.mark_duplicates)
+    app.get_source = timings.wrap("db_lookup", app.get_source)
+    app.get_pending_document = timings.wrap("db_lookup", app.get_pending_document)
+    app.store_document = timings.wrap("store_document", app.store_document)
+
+
+def seed(engine):
+    user_id = str(uuid.uuid4())
+    zendesk_id, hubspot_id = str(uuid.uuid4()), str(uuid.uuid4())
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "insert into \"user\" (id, email, hashed_password, is_active, is_superuser, is_verified) "
+                "values (:id, :email, '', true, false, true)"
+            ),
+            {"id": user_id, "email": f"bench-{user_id}@example.com"},
+        )
+        extra = {"access_token": "bench", "refresh_token": "bench"}
+        connection.execute(
+            text("insert into source (id, owner, name, extra) values (:id, :owner, :name, :extra)"),
+            [
+                {"id": zendesk_id, "owner": user_id, "name": "zendesk_integration",
+                 "extra": json.dumps({**extra, "subdomain": ZENDESK_SUBDOMAIN})},
+                {"id": hubspot_id, "owner": user_id, "name": "hubspot_integration",
+                 "extra": json.dumps({**extra, "subdomain": HUBSPOT_SUBDOMAIN})},
+            ],
+        )
+    return user_id, zendesk_id, hubspot_id
+
+
+def cleanup(engine, user_id):
+    with engine.begin() as connection:
+        for table, column in [("document", "owner"), ("source", "owner"), ("\"user\"", "id")]:
+            connection.execute(text(f"delete from {table} where {column} = :user_id"), {"user_id": user_id})
+
+
+def generate_documents(count, doc_types, zendesk_id, hubspot_id, offset):
+    documents = []
+    for i in range(count):
+        doc_type = doc_types[i % len(doc_types)]
+        doc_id = str(offset + i)
+        document = {
+            "source_id": hubspot_id if doc_type.startswith("hubspot") else zendesk_id,
+            "doc_type": doc_type,
+            "doc_id": doc_id,
+            "doc_last_updated": "2022-06-01T12:00:00Z",
+        }
+        if doc_type == "hubspot_help_center_article":
+            document["doc_url"] = f"https://{HUBSPOT_SUBDOMAIN}/kb/{doc_id}"
+            document["doc_name"] = f"Updating your billing address ({doc_id})"
+        if doc_type == "hubspot_ticket":
+            document["portal_id"] = "12345"
+        documents.append(document)
+    return documents
+
+
+def run_batch_size(engine, index, bi_encoder, timings, documents, batch_size):
+    records = [
+        {"body": json.dumps({"documents": list(batch)})}
+        for batch in app.chunks(documents, batch_size=batch_size)
+    ]
+    timings.seconds.clear()
+    chunk_count = len(index.vectors)
+    start = time.perf_counter()
+    for record in records:
+        app.process_documents(engine, index, bi_encoder, app.get_record_documents(record))
+    elapsed = time.perf_counter() - start
+    chunk_count = len(index.vectors) - chunk_count
+
+    stages = dict(timings.seconds)
+    return {
+        "batch_size": batch_size,
+        "documents": len(documents),
+        "chunks": chunk_count,
+        "seconds": round(elapsed, 3),
+        "documents_per_second": round(len(documents) / elapsed, 2),
+        "chunks_per_second": round(chunk_count / elapsed, 2),
+        "stage_seconds": {name: round(seconds, 3) for name, seconds in sorted(stages.items())},
+    }
+
+
+def main(args):
+    fixtures = load_fixtures()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_stub_handler(fixtures, args.fetch_latency_ms / 1000))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    timings = Timings()
+    install_stand_ins(f"http://127.0.0.1:{server.server_address[1]}", timings)
+    os.environ.setdefault("PINECONE_NAMESPACE", "bench")
+    dedup.DEDUP_THRESHOLD = args.dedup_threshold
+
+    if args.fake_encoder:
+        encoder = FakeEncoder()
+    else:
+        from sentence_transformers import SentenceTransformer
+        encoder = SentenceTransformer(args.model)
+    bi_encoder = type("TimedEncoder", (), {"encode": staticmethod(timings.wrap("encode", encoder.encode))})()
+    index = InMemoryIndex()
+    index.upsert = timings.wrap("upsert", index.upsert)
+
+    engine = create_engine(os.environ["SQLALCHEMY_DATABASE_URL"])
+    user_id, zendesk_id, hubspot_id = seed(engine)
+    results = []
+    try:
+        # Warm up the encoder and connection pools outside the measured runs.
+        warmup = generate_documents(len(args.doc_types), args.doc_types, zendesk_id, hubspot_id, 0)
+        run_batch_size(engine, index, bi_encoder, timings, warmup, len(warmup))
+        for i, batch_size in enumerate(args.batch_sizes):
+            offset = (i + 1) * args.documents
+            documents = generate_documents(args.documents, args.doc_types, zendesk_id, hubspot_id, offset)
+            result = run_batch_size(engine, index, bi_encoder, timings, documents, batch_size)
+            stages = " ".join(f"{name}={seconds}s" for name, seconds in result["stage_seconds"].items())
+            print(
+                f"batch_size={batch_size} docs/s={result['documents_per_second']} "
+                f"chunks/s={result['chunks_per_second']} {stages}"
+            )
+            results.append(result)
+    finally:
+        cleanup(engine, user_id)
+        engine.dispose()
+        server.shutdown()
+
+    if args.compare:
+        compare_results(args.compare, results, "batch_size", ["documents_per_second", "chunks_per_second"])
+    config = {key: value for key, value in vars(args).items() if key not in ["output", "compare"]}
+    save_results(args.output, "ingest", config, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=200, help="documents per batch size")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--doc-types", nargs="+", default=DOC_TYPES, choices=DOC_TYPES)
+    parser.add_argument("--fetch-latency-ms", type=float, default=0, help="added to every stub response")
+    parser.add_argument("--model", default="/mnt/bi_encoder")
+    parser.add_argument("--fake-encoder", action="store_true")
+    parser.add_argument(
+        "--dedup-threshold", type=float, default=1.1,
+        help="fixture documents differ only in their ids, so dedup is off (above 1) unless set",
+    )
+    parser.add_argument("--output", default="results/ingest.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    main(parser.parse_args())
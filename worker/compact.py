@@ -0,0 +1,154 @@
+"""Delete vectors that no document uses any more.
+
+Vector ids are positional. When an article loses sections or a ticket loses
+comments, its highest-numbered ids stop being written. Every document row
+keeps chunk_ids, the ids it was last indexed with, and on re-indexing the
+worker deletes the ids that dropped out with release_chunks.
+
+The compaction handler runs on a schedule and cleans up what re-indexing
+cannot:
+
+- documents whose source has been removed, along with all of the source's
+  vectors
+- chunk fingerprints that no document lists and no duplicate points at. These
+  are vectors release_chunks kept because near-duplicates were collapsed into
+  them.
+
+Run it as a Lambda with CMD ["compact.handler"] on the worker image, or as:
+
+    python3 compact.py
+"""
+import logging
+import os
+
+import pinecone
+from sqlalchemy import create_engine, text
+
+logger = logging.getLogger()
+
+# Pinecone accepts at most this many ids per delete request.
+DELETE_BATCH_SIZE = 1000
+COMPACT_LIMIT = int(os.getenv("COMPACT_LIMIT", 10000))
+
+
+def delete_vectors(index, vector_ids):
+    vector_ids = list(vector_ids)
+    for i in range(0, len(vector_ids), DELETE_BATCH_SIZE):
+        index.delete(ids=vector_ids[i:i + DELETE_BATCH_SIZE], namespace=os.environ["PINECONE_NAMESPACE"])
+
+
+def release_chunks(engine, index, source_id, vector_ids, keep=()):
+    """Delete the vectors and fingerprints of chunks a document no longer has.
+
+    Vectors that other chunks were collapsed into stay, as do the ids in keep.
+    Compaction deletes them once nothing points at them.
+    """
+    vector_ids = [vector_id for vector_id in vector_ids if vector_id not in keep]
+    if not vector_ids:
+        return
+    params = {"source_id": str(source_id), "vector_ids": vector_ids}
+    with engine.begin() as connection:
+        referenced = {
+            row.canonical_id for row in connection.execute(
+                text("""
+                    select distinct canonical_id from chunk_fingerprint
+                    where source_id = :source_id and canonical_id = any(cast(:vector_ids as text[]))
+                    and vector_id <> canonical_id
+                """),
+                params
+            )
+        }
+        params["vector_ids"] = [vector_id for vector_id in vector_ids if vector_id not in referenced]
+        connection.execute(
+            text("""
+                delete from chunk_fingerprint
+                where source_id = :source_id and vector_id = any(cast(:vector_ids as text[]))
+            """),
+            params
+        )
+        # Inside the transaction, so the fingerprints stay if the delete fails.
+        delete_vectors(index, params["vector_ids"])
+
+
+def get_removed_sources(engine):
+    with engine.connect() as connection:
+        return [
+            row.source_id for row in connection.execute(
+                text("""
+                    select distinct source_id from document
+                    where source_id is not null
+                    and not exists (select 1 from source where source.id = document.source_id)
+                """)
+            )
+        ]
+
+
+def compact_removed_source(engine, index, source_id):
+    """Delete the vectors and document rows of a removed source. Returns the number of documents.
+
+    The source's chunk_fingerprint rows are deleted with it, so split copies and
+    canonical vectors that only duplicates pointed at can no longer be listed.
+    After deleting the ids the documents know about, the rest are deleted with
+    the source_id metadata filter, which every vector of the source carries.
+    """
+    params = {"source_id": str(source_id)}
+    with engine.begin() as connection:
+        documents = connection.execute(
+            text("select chunk_ids from document where source_id = :source_id"), params
+        ).fetchall()
+        delete_vectors(index, [vector_id for document in documents for vector_id in document.chunk_ids or []])
+        index.delete(filter={"source_id": {"$eq": str(source_id)}}, namespace=os.environ["PINECONE_NAMESPACE"])
+        connection.execute(text("delete from document where source_id = :source_id"), params)
+    return len(documents)
+
+
+def compact_orphaned_chunks(engine, index):
+    """Delete up to COMPACT_LIMIT fingerprinted chunks that nothing uses. Returns how many.
+
+    Sources that still have documents without chunk_ids are skipped, since
+    their chunks cannot be told apart from orphans.
+    """
+    with engine.begin() as connection:
+        rows = connection.execute(
+            text("""
+                delete from chunk_fingerprint
+                where (source_id, vector_id) in (
+                    select f.source_id, f.vector_id from chunk_fingerprint f
+                    where not exists (
+                        select 1 from document d
+                        where d.source_id = f.source_id and d.chunk_ids @> array[f.vector_id]
+                    )
+                    and not exists (
+                        select 1 from chunk_fingerprint o
+                        where o.source_id = f.source_id and o.canonical_id = f.vector_id
+                        and o.vector_id <> o.canonical_id
+                    )
+                    and not exists (
+                        select 1 from document d
+                        where d.source_id = f.source_id and d.chunk_ids is null
+                    )
+                    limit :limit
+                )
+                returning vector_id
+            """),
+            {"limit": COMPACT_LIMIT}
+        ).fetchall()
+        delete_vectors(index, [row.vector_id for row in rows])
+    return len(rows)
+
+
+def handler(event, context):
+    pinecone.init(api_key=os.environ["PINECONE_KEY"], environment="us-west1-gcp")
+    index = pinecone.Index(index_name="semantic-text-search")
+    engine = create_engine(os.environ["SQLALCHEMY_DATABASE_URL"])
+    for source_id in get_removed_sources(engine):
+        count = compact_removed_source(engine, index, source_id)
+        logger.info(f"Deleted {count} documents of removed source {source_id}")
+    count = compact_orphaned_chunks(engine, index)
+    logger.info(f"Deleted {count} orphaned chunks")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    handler({}, None)
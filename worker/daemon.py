@@ -0,0 +1,203 @@
+"""Long-running queue consumer, for running the worker outside Lambda.
+
+    python3 daemon.py
+
+Long-polls SQS_QUEUE_NAME. When SQS_ENDPOINT_URL is set it polls that endpoint
+instead, e.g. the ElasticMQ container in docker-compose.yml. Received
+documents go through the same pipeline as the Lambda handler:
+FETCH_WORKERS fetch threads, a parse thread, a single encoder that encodes
+chunks from many documents together, and an upsert thread. The pipeline's
+bounded queues pause polling while it is full. The encoder, database pool and
+HTTP sessions stay loaded between messages.
+
+A message is deleted once all of its documents are done. Parse errors are
+logged and the document is skipped, as in the Lambda handler. A document that
+is gone upstream (404 or 410) is removed from the index. Any other failure,
+including rate limits, timeouts and server errors from the fetch, leaves the
+message in the queue, and it is received again after its visibility timeout. While a message is in the
+pipeline its visibility timeout is extended, so a slow backlog does not make it
+visible to other consumers halfway through.
+
+SIGTERM or SIGINT stops polling. Documents already received are finished
+before the process exits.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+import boto3
+import pinecone
+from sentence_transformers import SentenceTransformer
+from sqlalchemy import create_engine
+
+from app import FETCH_WORKERS, PIPELINE_QUEUE_SIZE, get_pipeline_stages, get_record_documents
+from pipeline import Stage, run_pipeline
+
+logger = logging.getLogger()
+
+POLL_WAIT_SECONDS = 20
+POLL_RETRY_SECONDS = 5
+# Errors in these stages come from the document itself, so retrying will not help.
+# Fetch errors are not among them: a document that is gone upstream is not an
+# error, and rate limits, timeouts and server errors pass.
+SKIPPED_STAGES = {"parse"}
+
+
+class Message:
+    """Tracks the documents of one queue message until they are all done."""
+
+    def __init__(self, receipt_handle, count):
+        self.receipt_handle = receipt_handle
+        self.remaining = count
+        self.extended = time.monotonic()
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def done(self, failed=False):
+        """Mark one document done. Returns True when it was the last one."""
+        with self.lock:
+            self.failed = self.failed or failed
+            self.remaining -= 1
+            return self.remaining == 0
+
+
+class Daemon:
+    def __init__(self, sqs, queue_url, engine, index, bi_encoder, visibility_timeout):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.engine = engine
+        self.index = index
+        self.bi_encoder = bi_encoder
+        self.visibility_timeout = visibility_timeout
+        self.stopping = threading.Event()
+        self.finished = threading.Event()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def receive(self):
+        """Yield pipeline items for received documents until stopping is set."""
+        while not self.stopping.is_set():
+            try:
+                response = self.sqs.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=10,
+                    WaitTimeSeconds=POLL_WAIT_SECONDS,
+                )
+            except Exception as e:
+                logger.error(e)
+                self.stopping.wait(POLL_RETRY_SECONDS)
+                continue
+            for sqs_message in response.get("Messages", []):
+                try:
+                    documents = get_record_documents({"body": sqs_message["Body"]})
+                except Exception as e:
+                    logger.error(e)
+                    continue
+                message = Message(sqs_message["ReceiptHandle"], len(documents))
+                with self.lock:
+                    self.in_flight[message.receipt_handle] = message
+                if not documents:
+                    self.finish(message)
+                for record_body in documents:
+                    yield {"record_body": record_body, "message": message}
+
+    def done(self, item, failed=False):
+        if item["message"].done(failed):
+            self.finish(item["message"])
+
+    def finish(self, message):
+        with self.lock:
+            self.in_flight.pop(message.receipt_handle, None)
+        if message.failed:
+            return
+        # Raising here would reach ack's on_error and count the message's documents done twice.
+        try:
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message.receipt_handle)
+        except Exception as e:
+            logger.error(f"Failed to delete message {message.receipt_handle}: {e}")
+
+    def on_error(self, stage_name, items, error):
+        for item in items:
+            self.done(item, failed=stage_name not in SKIPPED_STAGES)
+
+    def ack(self, items):
+        for item in items:
+            self.done(item)
+        return items
+
+    def extend_visibility(self):
+        """Keep in-flight messages hidden until the pipeline is done with them.
+
+        Every third of the visibility timeout, messages that were last extended
+        at least that long ago get a full timeout again.
+        """
+        interval = self.visibility_timeout / 3
+        while not self.finished.wait(interval):
+            now = time.monotonic()
+            with self.lock:
+                due = [message for message in self.in_flight.values() if now - message.extended >= interval]
+            for i in range(0, len(due), 10):
+                batch = due[i:i + 10]
+                try:
+                    response = self.sqs.change_message_visibility_batch(
+                        QueueUrl=self.queue_url,
+                        Entries=[
+                            {
+                                "Id": str(j),
+                                "ReceiptHandle": message.receipt_handle,
+                                "VisibilityTimeout": self.visibility_timeout,
+                            }
+                            for j, message in enumerate(batch)
+                        ],
+                    )
+                except Exception as e:
+                    logger.error(e)
+                    continue
+                failed = {failure["Id"] for failure in response.get("Failed", [])}
+                for j, message in enumerate(batch):
+                    if str(j) in failed:
+                        logger.error(f"Failed to extend the visibility of message {message.receipt_handle}")
+                    else:
+                        message.extended = now
+
+    def run(self):
+        stages = get_pipeline_stages(self.engine, self.index, self.bi_encoder, on_error=self.on_error)
+        stages.append(Stage("ack", self.ack, on_error=self.on_error))
+        extender = threading.Thread(target=self.extend_visibility, daemon=True)
+        extender.start()
+        try:
+            run_pipeline(self.receive(), stages, queue_size=PIPELINE_QUEUE_SIZE)
+        finally:
+            self.finished.set()
+            extender.join()
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    sqs = boto3.client("sqs", region_name="us-east-1", endpoint_url=os.getenv("SQS_ENDPOINT_URL"))
+    queue_url = sqs.get_queue_url(QueueName=os.environ["SQS_QUEUE_NAME"])["QueueUrl"]
+    visibility_timeout = int(
+        sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["VisibilityTimeout"])["Attributes"]["VisibilityTimeout"]
+    )
+    pinecone.init(api_key=os.environ["PINECONE_KEY"], environment="us-west1-gcp")
+    index = pinecone.Index(index_name="semantic-text-search")
+    bi_encoder = SentenceTransformer("/mnt/bi_encoder")
+    engine = create_engine(
+        os.environ["SQLALCHEMY_DATABASE_URL"], pool_size=FETCH_WORKERS + 1, pool_pre_ping=True
+    )
+    daemon = Daemon(sqs, queue_url, engine, index, bi_encoder, visibility_timeout)
+
+    def stop(signum, frame):
+        logger.info("Stopping after in-flight documents finish")
+        daemon.stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    daemon.run()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Collapse near-duplicate chunks within a source before they are encoded.
+
+Ticket comments repeat macros, signatures and canned replies, and help center
+articles share boilerplate sections. Every chunk gets a MinHash signature over
+its word shingles. When two chunks of the same source and doc_type agree on at
+least DEDUP_THRESHOLD of their signature values, only the first is encoded and
+upserted. The later one gets duplicate_of set to the first one's vector id, and
+that vector's doc_refs metadata lists the URL of every document it stands for.
+
+Signatures are kept in chunk_fingerprint, so chunks are also matched against
+earlier runs. The lookup uses LSH: signatures are split into BANDS bands, and
+only chunks that share a whole band are compared.
+
+A chunk that already holds a vector is never turned into a duplicate. Other
+chunks may point at that vector, so it has to stay. If its own text changes
+so much that it no longer matches what it stored, the old vector is first
+copied to a new id and the chunks pointing at it move there. Otherwise
+re-encoding would leave them pointing at unrelated content.
+"""
+import logging
+from collections import defaultdict, namedtuple
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+from sqlalchemy import text
+
+logger = logging.getLogger()
+
+Fingerprint = namedtuple("Fingerprint", ["vector_id", "signature", "bands"])
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))
+# Keeps the vector's metadata well under Pinecone's size limit.
+MAX_DOC_REFS = 50
+
+# Signatures are stored, so the permutations must never change.
+_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_random = np.random.RandomState(1)
+_A = _random.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+_B = _random.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+
+def get_shingles(text_to_index):
+    words = re.findall(r"\w+", text_to_index.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def minhash(text_to_index):
+    hashes = np.array([zlib.crc32(shingle.encode()) for shingle in get_shingles(text_to_index)], dtype=np.uint64)
+    permuted = (np.outer(hashes, _A) + _B) % _PRIME & _MAX_HASH
+    return permuted.min(axis=0).tolist()
+
+
+def get_bands(doc_type, signature):
+    """LSH keys for a signature. The doc_type is part of each key, so only chunks of the same type match."""
+    bands = []
+    for i in range(BANDS):
+        rows = ",".join(str(value) for value in signature[i * ROWS:(i + 1) * ROWS])
+        bands.append(f"{doc_type}:{i}:{hashlib.blake2b(rows.encode(), digest_size=8).hexdigest()}")
+    return bands
+
+
+def similarity(signature, other):
+    return sum(a == b for a, b in zip(signature, other)) / NUM_PERM
+
+
+def get_fingerprints(engine, source_id, vector_ids, bands):
+    """Rows for the given vector ids, canonical rows sharing any of bands, and rows referencing vector_ids."""
+    params = {"source_id": source_id, "vector_ids": vector_ids, "bands": bands}
+    with engine.connect() as connection:
+        existing = connection.execute(
+            text("""
+                select vector_id, canonical_id, signature, bands from chunk_fingerprint
+                where source_id = :source_id and vector_id = any(cast(:vector_ids as text[]))
+            """),
+            params
+        ).fetchall()
+        candidates = connection.execute(
+            text("""
+                select vector_id, signature, bands from chunk_fingerprint
+                where source_id = :source_id and canonical_id = vector_id
+                and bands && cast(:bands as text[])
+            """),
+            params
+        ).fetchall()
+        references = connection.execute(
+            text("""
+                select vector_id, canonical_id, doc_url from chunk_fingerprint
+                where source_id = :source_id and canonical_id = any(cast(:vector_ids as text[]))
+                and vector_id <> canonical_id
+            """),
+            params
+        ).fetchall()
+    return existing, candidates, references
+
+
+def find_duplicate(buckets, result):
+    best, best_similarity = None, DEDUP_THRESHOLD
+    for band in result["bands"]:
+        for vector_id, signature in buckets.get(band, []):
+            if vector_id == result["id"]:
+                continue
+            score = similarity(result["signature"], signature)
+            if score >= best_similarity:
+                best, best_similarity = vector_id, score
+    return best
+
+
+def split_canonical(engine, index, source_id, canonical, dependents):
+    """Move the chunks collapsed into a canonical vector to a copy of it.
+
+    Called before the canonical's own chunk is re-encoded with text that no
+    longer matches. The copy keeps the old embedding and text, takes its
+    name and URL from the first dependent, and gets a fingerprint row so
+    later chunks can still match the old content. Returns that row, or None
+    if the vector is missing.
+    """
+    namespace = os.environ["PINECONE_NAMESPACE"]
+    signature_hash = hashlib.blake2b(",".join(map(str, canonical.signature)).encode(), digest_size=4).hexdigest()
+    copy_id = f"{canonical.vector_id}-{signature_hash}"
+    vector = index.fetch(ids=[canonical.vector_id], namespace=namespace)["vectors"].get(canonical.vector_id)
+    if not vector:
+        logger.error(f"Canonical vector {canonical.vector_id} is missing, leaving its duplicates in place")
+        return
+    doc_url = dependents[0].doc_url
+    params = {
+        "source_id": str(source_id),
+        "vector_id": canonical.vector_id,
+        "copy_id": copy_id,
+        "doc_url": doc_url,
+        "signature": canonical.signature,
+        "bands": canonical.bands,
+        "dependent_id": dependents[0].vector_id,
+    }
+    with engine.begin() as connection:
+        doc_name = connection.execute(
+            text("""
+                select name from document
+                where source_id = :source_id and chunk_ids @> array[cast(:dependent_id as varchar)]
+            """),
+            params
+        ).scalar()
+        metadata = {**vector["metadata"], "doc_url": doc_url}
+        metadata["doc_refs"] = list(dict.fromkeys(row.doc_url for row in dependents if row.doc_url))[:MAX_DOC_REFS]
+        if doc_name:
+            metadata["doc_name"] = doc_name
+        index.upsert(vectors=[(copy_id, vector["values"], metadata)], namespace=namespace)
+        connection.execute(
+            text("""
+                insert into chunk_fingerprint (source_id, vector_id, canonical_id, doc_url, signature, bands)
+                values (:source_id, :copy_id, :copy_id, :doc_url, :signature, :bands)
+                on conflict do nothing
+            """),
+            params
+        )
+        connection.execute(
+            text("""
+                update chunk_fingerprint set canonical_id = :copy_id
+                where source_id = :source_id and canonical_id = :vector_id and vector_id <> canonical_id
+            """),
+            params
+        )
+    return Fingerprint(copy_id, canonical.signature, canonical.bands)
+
+
+def mark_source_duplicates(engine, index, source_id, results):
+    vector_ids = [result["id"] for result in results]
+    bands = sorted({band for result in results for band in result["bands"]})
+    existing, candidates, references = get_fingerprints(engine, source_id, vector_ids, bands)
+    indexed = {row.vector_id: row for row in existing if row.vector_id == row.canonical_id}
+    dependents = defaultdict(list)
+    for row in references:
+        dependents[row.canonical_id].append(row)
+
+    buckets = defaultdict(list)
+    for result in results:
+        row = indexed.get(result["id"])
+        if row is None:
+            continue
+        if dependents[row.vector_id] and similarity(result["signature"], row.signature) < DEDUP_THRESHOLD:
+            copy = split_canonical(engine, index, source_id, row, dependents.pop(row.vector_id))
+            if copy:
+                candidates.append(copy)
+        # Indexed chunks match on their new text, never on what they stored before.
+        for band in result["bands"]:
+            buckets[band].append((result["id"], result["signature"]))
+    for row in candidates:
+        if row.vector_id in indexed:
+            continue
+        for band in row.bands:
+            buckets[band].append((row.vector_id, row.signature))
+    for result in results:
+        if result["id"] in indexed:
+            continue
+        result["duplicate_of"] = find_duplicate(buckets, result)
+        if result["duplicate_of"] is None:
+            for band in result["bands"]:
+                buckets[band].append((result["id"], result["signature"]))
+
+    doc_refs = defaultdict(list)
+    for canonical_id, rows in dependents.items():
+        doc_refs[canonical_id].extend(row.doc_url for row in rows)
+    for result in results:
+        if result["duplicate_of"]:
+            doc_refs[result["duplicate_of"]].append(result["doc_url"])
+    for result in results:
+        if result["duplicate_of"] is None:
+            refs = [result["doc_url"]] + doc_refs[result["id"]]
+            result["doc_refs"] = list(dict.fromkeys(refs))[:MAX_DOC_REFS]
+
+
+def mark_duplicates(engine, index, documents):
+    """Fingerprint the chunks of documents and set duplicate_of on near-duplicates.
+
+    Chunks are compared with the other chunks passed in and with those already
+    in chunk_fingerprint. Chunks left with duplicate_of None are the ones to
+    encode, and get doc_refs for their metadata.
+    """
+    by_source = defaultdict(list)
+    for document in documents:
+        for result in document["results"] or []:
+            result["signature"] = minhash(result["text_to_index"])
+            result["bands"] = get_bands(result["doc_type"], result["signature"])
+            result["duplicate_of"] = None
+            by_source[result["source_id"]].append(result)
+    for source_id, results in by_source.items():
+        mark_source_duplicates(engine, index, source_id, results)
+
+
+def record_fingerprints(engine, index, document):
+    """Store the fingerprints of an indexed document's chunks.
+
+    Also refreshes doc_refs on vectors this document's chunks now point at, or
+    pointed at before.
+    """
+    results = document["results"]
+    source_id = str(document["source_id"])
+    params = {"source_id": source_id, "vector_ids": [result["id"] for result in results]}
+    with engine.begin() as connection:
+        previous = connection.execute(
+            text("""
+                select canonical_id from chunk_fingerprint
+                where source_id = :source_id and vector_id = any(cast(:vector_ids as text[]))
+                and vector_id <> canonical_id
+            """),
+            params
+        ).fetchall()
+        connection.execute(
+            text("""
+                insert into chunk_fingerprint (source_id, vector_id, canonical_id, doc_url, signature, bands)
+                values (:source_id, :vector_id, :canonical_id, :doc_url, :signature, :bands)
+                on conflict (source_id, vector_id) do update set
+                    canonical_id = excluded.canonical_id,
+                    doc_url = excluded.doc_url,
+                    signature = excluded.signature,
+                    bands = excluded.bands
+            """),
+            [
+                {
+                    "source_id": source_id,
+                    "vector_id": result["id"],
+                    "canonical_id": result["duplicate_of"] or result["id"],
+                    "doc_url": result["doc_url"],
+                    "signature": result["signature"],
+                    "bands": result["bands"],
+                }
+                for result in results
+            ]
+        )
+        affected = {row.canonical_id for row in previous}
+        affected.update(result["duplicate_of"] for result in results if result["duplicate_of"])
+        if not affected:
+            return
+        references = connection.execute(
+            text("""
+                select canonical_id, array_agg(distinct doc_url) as doc_refs from chunk_fingerprint
+                where source_id = :source_id and canonical_id = any(cast(:canonical_ids as text[]))
+                group by canonical_id
+                having bool_or(vector_id = canonical_id)
+            """),
+            {"source_id": source_id, "canonical_ids": sorted(affected)}
+        ).fetchall()
+    for row in references:
+        doc_refs = [doc_url for doc_url in row.doc_refs if doc_url][:MAX_DOC_REFS]
+        index.update(id=row.canonical_id, set_metadata={"doc_refs": doc_refs}, namespace=os.environ["PINECONE_NAMESPACE"])
@@ -0,0 +1,105 @@
+"""Run items through a chain of worker threads connected by bounded queues.
+
+Each stage has its own threads and reads from a queue that holds at most
+queue_size items. A slow stage fills its input queue and blocks the stages
+before it, so memory stays bounded. Meanwhile the other stages keep working,
+so I/O-bound and CPU-bound stages overlap and a batch takes roughly as long
+as its slowest stage.
+"""
+import logging
+import queue
+import threading
+
+logger = logging.getLogger()
+
+_STOP = object()
+
+
+class Stage:
+    """One step of a pipeline.
+
+    func takes a list of items and returns the items to pass on. A stage with
+    batch_size > 1 passes func whatever is already queued, up to batch_size
+    items, or up to batch_size total weight when weight is given. If func
+    raises, the error is logged, on_error(stage_name, items, exception) is
+    called if given, and those items are dropped.
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=1, weight=None, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.weight = weight or (lambda item: 1)
+        self.on_error = on_error
+
+
+def _next_batch(stage, inbox):
+    """Block for one item, then take whatever else is queued up to the batch size.
+
+    Returns the batch and whether the stop marker was reached.
+    """
+    item = inbox.get()
+    if item is _STOP:
+        return [], True
+    batch = [item]
+    total = stage.weight(item)
+    while total < stage.batch_size:
+        try:
+            item = inbox.get_nowait()
+        except queue.Empty:
+            break
+        if item is _STOP:
+            return batch, True
+        batch.append(item)
+        total += stage.weight(item)
+    return batch, False
+
+
+def run_pipeline(items, stages, queue_size=16):
+    """Push items through stages and return once every item has left the last one."""
+    inboxes = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining = [stage.workers for stage in stages]
+    lock = threading.Lock()
+
+    def work(i):
+        stage, inbox = stages[i], inboxes[i]
+        outbox = inboxes[i + 1] if i + 1 < len(stages) else None
+        stopped = False
+        while not stopped:
+            batch, stopped = _next_batch(stage, inbox)
+            if not batch:
+                continue
+            try:
+                batch = stage.func(batch)
+            except Exception as e:
+                logger.error(e)
+                if stage.on_error:
+                    try:
+                        stage.on_error(stage.name, batch, e)
+                    except Exception as e:
+                        logger.error(e)
+                continue
+            if outbox is not None:
+                for item in batch:
+                    outbox.put(item)
+        # Let this stage's other workers see the stop marker too.
+        inbox.put(_STOP)
+        with lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last and outbox is not None:
+            outbox.put(_STOP)
+
+    threads = [
+        threading.Thread(target=work, args=(i,), daemon=True)
+        for i, stage in enumerate(stages)
+        for _ in range(stage.workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for item in items:
+        inboxes[0].put(item)
+    inboxes[0].put(_STOP)
+    for thread in threads:
+        thread.join()